@@ -20,12 +20,15 @@ for this script to work
 import time
 import argparse
 import sys
+import os
 import structlog
 import logging
 import CloudFlare
 import requests
-from requests.adapters import HTTPAdapter
 import dns.resolver
+# Share the HTTP adapters & rate limiter with flaredns.py in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from flaredns import TimeoutHTTPAdapter, RateLimitedHTTPAdapter, make_rate_limit_bucket
 
 logger = structlog.get_logger()
 
@@ -88,23 +91,6 @@ def check_and_perform_ipv6_update(cf, hostname, zone_id, current_ipv6):
     else:
         logger.debug("IPv6 record already up-to-date", ip=current_ipv6, hostname=hostname)
 
-DEFAULT_TIMEOUT = 5 # seconds
-
-class TimeoutHTTPAdapter(HTTPAdapter):
-    """Original source: https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks/"""
-    def __init__(self, *args, **kwargs):
-        self.timeout = DEFAULT_TIMEOUT
-        if "timeout" in kwargs:
-            self.timeout = kwargs["timeout"]
-            del kwargs["timeout"]
-        super().__init__(*args, **kwargs)
-
-    def send(self, request, **kwargs):
-        timeout = kwargs.get("timeout")
-        if timeout is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-e", "--email", required=True, help="The Cloudflare login email to use")
@@ -116,6 +102,10 @@ if __name__ == "__main__":
     parser.add_argument("-6", "--ipv6", action="store_true", help="Update AAAA record with the current IPv6")
     parser.add_argument("-d", "--debug", action="store_true", help="Additional debug logging")
     parser.add_argument("-i", "--interval", type=int, default=120, help="The update interval in seconds. Set to 0 to only update once. Strictly speaking the sleep time after any update attempt")
+    parser.add_argument("--rate-limit", type=int, default=1200, help="Maximum number of Cloudflare API requests per --rate-limit-window. Set to 0 to disable client-side rate limiting")
+    parser.add_argument("--rate-limit-window", type=float, default=300, help="Rate limit window in seconds")
+    parser.add_argument("--rate-limit-burst", type=int, default=100, help="Maximum number of Cloudflare API requests in a burst")
+    parser.add_argument("--rate-limit-file", default=None, help="Share the rate limit budget with other processes (FlareDNS or CopyDNS) using the same file")
     args = parser.parse_args()
 
     if args.debug:
@@ -137,7 +127,11 @@ if __name__ == "__main__":
     )
     # Force set timeout for Cloudflare requests (so the request doesn't stall during reconnect events)
     cf._base.network.session = requests.Session()
-    adapter = TimeoutHTTPAdapter(timeout=2.5)
+    if args.rate_limit > 0:
+        bucket = make_rate_limit_bucket(args.rate_limit, args.rate_limit_window, args.rate_limit_burst, filename=args.rate_limit_file)
+        adapter = RateLimitedHTTPAdapter(timeout=2.5, bucket=bucket)
+    else:
+        adapter = TimeoutHTTPAdapter(timeout=2.5)
     cf._base.network.session.mount("https://", adapter)
     cf._base.network.session.mount("http://", adapter)
     # Get zone ID. This is done only once and it's assumed to not chage
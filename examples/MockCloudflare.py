@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the Cloudflare v4 API and for ipify, so FlareDNS can be
+tested and benchmarked without a Cloudflare account or internet access.
+
+Supported Cloudflare endpoints (below /client/v4):
+- GET /zones?name=...
+- GET/POST /zones/{zone_id}/dns_records (with name/type filters and pagination)
+- GET/PUT/PATCH/DELETE /zones/{zone_id}/dns_records/{record_id}
+- POST /zones/{zone_id}/dns_records/batch
+- GET /__stats: Number of requests per method & endpoint (not a Cloudflare API)
+
+The ipify stand-in (--ipify-port) serves the addresses set using --ipv4/--ipv6:
+- GET /ipv4, GET /ipv6: The current address as text
+- PUT /ipv4, PUT /ipv6: Set the address to the request body (e.g. to simulate renumbering)
+
+The STUN stand-in (--stun-port, UDP) answers Binding Requests with the same addresses
+(IPv4 for requests received via IPv4, IPv6 for requests via IPv6, so use --bind ::1 for IPv6).
+
+Router stand-ins answering with the IPv4 address of the ipify stand-in:
+- NAT-PMP and PCP (--natpmp-port, UDP): External address requests and PCP MAP requests
+- UPnP IGD (--upnp-port): Device description at /rootDesc.xml and the WANIPConnection
+  GetExternalIPAddress action. SSDP is not supported, so pass the description URL to FlareDNS:
+  --ipv4-source upnp --gateway http://127.0.0.1:8082/rootDesc.xml
+
+Example: Serve 1000 hosts in example.com and point FlareDNS to it:
+```
+python3 examples/MockCloudflare.py --zone example.com --records 1000 &
+python3 flaredns.py --email test@example.com --api-key test --hostname host0.example.com --ipv4 --ipv6 \\
+    --cloudflare-url http://127.0.0.1:8080/client/v4 \\
+    --ipv4-url http://127.0.0.1:8081/ipv4 --ipv6-url http://127.0.0.1:8081/ipv6 --allow-private
+```
+"""
+import argparse
+import collections
+import json
+import random
+import re
+import socket
+import socketserver
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import structlog
+
+logger = structlog.get_logger()
+
+# Cloudflare error codes used by the mock
+ERROR_RATE_LIMITED = 971
+ERROR_RECORD_NOT_FOUND = 81044
+ERROR_ZONE_NOT_FOUND = 7003
+ERROR_BAD_REQUEST = 9000
+ERROR_INTERNAL = 10000
+
+class MockCloudflareState:
+    """All zones & records plus the rate limiter, shared by all request handler threads"""
+    def __init__(self, rate_limit=1200, rate_window=300, max_per_page=5000):
+        self.lock = threading.Lock()
+        self.zones = {} # zone ID => {"id": ..., "name": ...}
+        self.records = {} # zone ID => {record ID => record}
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.max_per_page = max_per_page
+        self.request_times = collections.deque()
+        self.stats = collections.Counter()
+
+    def add_zone(self, name):
+        zone_id = uuid.uuid4().hex
+        self.zones[zone_id] = {"id": zone_id, "name": name, "status": "active"}
+        self.records[zone_id] = {}
+        return zone_id
+
+    def add_record(self, zone_id, data):
+        record_id = uuid.uuid4().hex
+        zone = self.zones[zone_id]
+        record = {
+            "id": record_id, "zone_id": zone_id, "zone_name": zone["name"],
+            "name": data["name"], "type": data["type"], "content": data["content"],
+            "ttl": data.get("ttl", 1), "proxied": data.get("proxied", False),
+        }
+        self.records[zone_id][record_id] = record
+        return record
+
+    def retry_after(self):
+        """Register a request. Returns 0 if it is allowed or the number of seconds to wait otherwise"""
+        now = time.monotonic()
+        with self.lock:
+            while self.request_times and self.request_times[0] <= now - self.rate_window:
+                self.request_times.popleft()
+            if self.rate_limit and len(self.request_times) >= self.rate_limit:
+                return max(1, int(self.request_times[0] + self.rate_window - now + 1))
+            self.request_times.append(now)
+            return 0
+
+class CloudflareAPIError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+def paginate(items, query, max_per_page):
+    page = max(1, int(query.get("page", 1)))
+    per_page = min(max_per_page, max(1, int(query.get("per_page", 100))))
+    result = items[(page - 1) * per_page:page * per_page]
+    result_info = {
+        "page": page, "per_page": per_page, "count": len(result),
+        "total_count": len(items), "total_pages": (len(items) + per_page - 1) // per_page,
+    }
+    return result, result_info
+
+class MockCloudflareHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+    state = None # MockCloudflareState, set in __main__
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    prefix = "/client/v4"
+
+    def log_message(self, format, *args):
+        logger.debug("Request", client=self.client_address[0], request=format % args)
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def do_PUT(self):
+        self.handle_api("PUT")
+
+    def do_PATCH(self):
+        self.handle_api("PATCH")
+
+    def do_DELETE(self):
+        self.handle_api("DELETE")
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, code, message, headers=None):
+        self.send_json(status, {"success": False, "errors": [{"code": code, "message": message}], "messages": [], "result": None}, headers=headers)
+
+    def read_body(self):
+        if not self.body:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise CloudflareAPIError(400, ERROR_BAD_REQUEST, "Invalid JSON body")
+
+    def handle_api(self, method):
+        # Always consume the body, so the connection can be reused after early error responses
+        self.body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path
+        if path == "/__stats":
+            with self.state.lock:
+                self.send_json(200, dict(self.state.stats))
+            return
+        if not path.startswith(self.prefix):
+            self.send_error_json(404, ERROR_BAD_REQUEST, "Unknown endpoint")
+            return
+        path = path[len(self.prefix):].rstrip("/")
+        # Simulate network & server latency
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        endpoint = re.sub(r"/[0-9a-f]{32}", "/:id", path)
+        with self.state.lock:
+            self.state.stats[f"{method} {endpoint}"] += 1
+        # Rate limiting
+        retry_after = self.state.retry_after()
+        if retry_after:
+            with self.state.lock:
+                self.state.stats["429"] += 1
+            self.send_error_json(429, ERROR_RATE_LIMITED, "Please wait and consider throttling your request speed", headers={"Retry-After": str(retry_after)})
+            return
+        # Error injection
+        if self.error_rate and random.random() < self.error_rate:
+            self.send_error_json(500, ERROR_INTERNAL, "Injected internal error")
+            return
+        try:
+            status, result, result_info = self.route(method, path, query)
+        except CloudflareAPIError as ex:
+            self.send_error_json(ex.status, ex.code, ex.message)
+            return
+        body = {"success": True, "errors": [], "messages": [], "result": result}
+        if result_info is not None:
+            body["result_info"] = result_info
+        self.send_json(status, body)
+
+    def route(self, method, path, query):
+        parts = path.strip("/").split("/")
+        state = self.state
+        with state.lock:
+            if parts == ["zones"] and method == "GET":
+                zones = [zone for zone in state.zones.values() if "name" not in query or zone["name"] == query["name"]]
+                return (200, *paginate(zones, query, 50))
+            if len(parts) < 3 or parts[0] != "zones" or parts[2] != "dns_records":
+                raise CloudflareAPIError(404, ERROR_BAD_REQUEST, "Unknown endpoint")
+            zone_id = parts[1]
+            if zone_id not in state.zones:
+                raise CloudflareAPIError(404, ERROR_ZONE_NOT_FOUND, "Invalid zone identifier")
+            records = state.records[zone_id]
+            if len(parts) == 3:
+                if method == "GET":
+                    matching = [record for record in records.values()
+                                if all(record[key] == query[key] for key in ("name", "type", "content") if key in query)]
+                    return (200, *paginate(matching, query, state.max_per_page))
+                if method == "POST":
+                    return 200, state.add_record(zone_id, self.read_body()), None
+            elif len(parts) == 4 and parts[3] == "batch" and method == "POST":
+                return 200, self.batch(zone_id, self.read_body() or {}), None
+            elif len(parts) == 4:
+                record_id = parts[3]
+                if record_id not in records:
+                    raise CloudflareAPIError(404, ERROR_RECORD_NOT_FOUND, "Record does not exist.")
+                if method == "GET":
+                    return 200, records[record_id], None
+                if method == "PUT":
+                    return 200, self.put(records[record_id], self.read_body() or {}), None
+                if method == "PATCH":
+                    return 200, self.patch(records[record_id], self.read_body() or {}), None
+                if method == "DELETE":
+                    del records[record_id]
+                    return 200, {"id": record_id}, None
+            raise CloudflareAPIError(405, ERROR_BAD_REQUEST, "Method not allowed")
+
+    @staticmethod
+    def put(record, data):
+        for key in ("name", "type", "content"):
+            if key not in data:
+                raise CloudflareAPIError(400, ERROR_BAD_REQUEST, f"Missing field {key}")
+        record.update({key: value for key, value in data.items() if key not in ("id", "zone_id", "zone_name")})
+        return record
+
+    @staticmethod
+    def patch(record, data):
+        record.update({key: value for key, value in data.items() if key not in ("id", "zone_id", "zone_name")})
+        return record
+
+    def batch(self, zone_id, data):
+        """Like Cloudflare: deletes, patches, puts, posts in that order, all or nothing"""
+        records = self.state.records[zone_id]
+        for operation in ("deletes", "patches", "puts"):
+            for entry in data.get(operation, []):
+                if entry.get("id") not in records:
+                    raise CloudflareAPIError(400, ERROR_RECORD_NOT_FOUND, f"{operation}: record {entry.get('id')} does not exist.")
+        result = {"deletes": [], "patches": [], "puts": [], "posts": []}
+        for entry in data.get("deletes", []):
+            result["deletes"].append(records.pop(entry["id"]))
+        for entry in data.get("patches", []):
+            result["patches"].append(dict(self.patch(records[entry["id"]], entry)))
+        for entry in data.get("puts", []):
+            result["puts"].append(dict(self.put(records[entry["id"]], entry)))
+        for entry in data.get("posts", []):
+            result["posts"].append(dict(self.state.add_record(zone_id, entry)))
+        return result
+
+class MockIpifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    addresses = {} # "ipv4"/"ipv6" => address
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        logger.debug("ipify request", client=self.client_address[0], request=format % args)
+
+    def send_text(self, status, text):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        family = urlparse(self.path).path.strip("/") or ("ipv6" if ":" in self.client_address[0] else "ipv4")
+        with self.lock:
+            address = self.addresses.get(family)
+        if address is None:
+            self.send_text(404, "Not found")
+        else:
+            self.send_text(200, address)
+
+    def do_PUT(self):
+        family = urlparse(self.path).path.strip("/")
+        address = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8").strip()
+        if family not in ("ipv4", "ipv6"):
+            self.send_text(404, "Not found")
+            return
+        with self.lock:
+            self.addresses[family] = address
+        logger.info("Changed address", family=family, address=address)
+        self.send_text(200, address)
+
+STUN_MAGIC_COOKIE = 0x2112A442
+
+class MockStunHandler(socketserver.BaseRequestHandler):
+    """Answers STUN Binding Requests with an XOR-MAPPED-ADDRESS of the ipify stand-in's address"""
+    def handle(self):
+        data, sock = self.request
+        if len(data) < 20:
+            return
+        msg_type, _, cookie, transaction_id = struct.unpack("!HHI12s", data[:20])
+        if msg_type != 0x0001 or cookie != STUN_MAGIC_COOKIE:
+            return
+        version = 6 if sock.family == socket.AF_INET6 and not self.client_address[0].startswith("::ffff:") else 4
+        with MockIpifyHandler.lock:
+            address = MockIpifyHandler.addresses.get(f"ipv{version}")
+        if address is None:
+            return
+        packed = socket.inet_pton(socket.AF_INET if version == 4 else socket.AF_INET6, address)
+        key = struct.pack("!I", STUN_MAGIC_COOKIE) + transaction_id
+        xor_address = bytes(a ^ b for a, b in zip(packed, key))
+        xor_port = self.client_address[1] ^ (STUN_MAGIC_COOKIE >> 16)
+        attribute = struct.pack("!BBH", 0, 0x01 if version == 4 else 0x02, xor_port) + xor_address
+        response = struct.pack("!HHI12s", 0x0101, 4 + len(attribute), STUN_MAGIC_COOKIE, transaction_id)
+        response += struct.pack("!HH", 0x0020, len(attribute)) + attribute
+        sock.sendto(response, self.client_address)
+        logger.debug("STUN request", client=self.client_address[0], address=address)
+
+class MockNatPmpHandler(socketserver.BaseRequestHandler):
+    """Answers NAT-PMP external address requests (version 0) and PCP MAP requests (version 2)"""
+    started_at = time.time()
+
+    def handle(self):
+        data, sock = self.request
+        with MockIpifyHandler.lock:
+            address = MockIpifyHandler.addresses.get("ipv4")
+        epoch = int(time.time() - self.started_at)
+        if data[:2] == b"\x00\x00" and address is not None:
+            response = struct.pack("!BBHI4s", 0, 128, 0, epoch, socket.inet_aton(address))
+        elif len(data) >= 60 and data[0] == 2 and data[1] == 1 and address is not None:
+            lifetime, = struct.unpack("!I", data[4:8])
+            nonce, protocol, internal_port = struct.unpack("!12sB3xH", data[24:42])
+            mapped_address = socket.inet_pton(socket.AF_INET6, "::ffff:" + address)
+            response = struct.pack("!BBBBII12x", 2, 0x81, 0, 0, lifetime, epoch)
+            response += struct.pack("!12sB3xHH16s", nonce, protocol, internal_port, internal_port, mapped_address)
+        elif data[:1] == b"\x00":
+            # NAT-PMP: Unsupported opcode
+            response = struct.pack("!BBHI", 0, 128 + (data[1] if len(data) > 1 else 0), 5, epoch)
+        else:
+            return
+        sock.sendto(response, self.client_address)
+        logger.debug("NAT-PMP/PCP request", client=self.client_address[0], version=data[0], address=address)
+
+class MockUpnpHandler(BaseHTTPRequestHandler):
+    """Serves a minimal UPnP Internet Gateway Device description and GetExternalIPAddress"""
+    SERVICE_TYPE = "urn:schemas-upnp-org:service:WANIPConnection:1"
+    DESCRIPTION = f"""<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:InternetGatewayDevice:1</deviceType>
+    <friendlyName>MockCloudflare router</friendlyName>
+    <deviceList><device>
+      <deviceType>urn:schemas-upnp-org:device:WANDevice:1</deviceType>
+      <deviceList><device>
+        <deviceType>urn:schemas-upnp-org:device:WANConnectionDevice:1</deviceType>
+        <serviceList><service>
+          <serviceType>{SERVICE_TYPE}</serviceType>
+          <serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>
+          <controlURL>/ctl/IPConn</controlURL>
+          <eventSubURL>/evt/IPConn</eventSubURL>
+          <SCPDURL>/WANIPCn.xml</SCPDURL>
+        </service></serviceList>
+      </device></deviceList>
+    </device></deviceList>
+  </device>
+</root>
+"""
+
+    def log_message(self, format, *args):
+        logger.debug("UPnP request", client=self.client_address[0], request=format % args)
+
+    def send_xml(self, status, text):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", 'text/xml; charset="utf-8"')
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/rootDesc.xml":
+            self.send_xml(200, self.DESCRIPTION)
+        else:
+            self.send_xml(404, "<error>Not found</error>")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        action = self.headers.get("SOAPAction", "").strip('"')
+        if urlparse(self.path).path != "/ctl/IPConn" or action != f"{self.SERVICE_TYPE}#GetExternalIPAddress":
+            self.send_xml(500, "<error>Invalid action</error>")
+            return
+        with MockIpifyHandler.lock:
+            address = MockIpifyHandler.addresses.get("ipv4") or ""
+        self.send_xml(200, f"""<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body><u:GetExternalIPAddressResponse xmlns:u="{self.SERVICE_TYPE}"><NewExternalIPAddress>{address}</NewExternalIPAddress></u:GetExternalIPAddressResponse></s:Body>
+</s:Envelope>
+""")
+
+def make_server(bind, port, handler):
+    """Create a threading HTTP server, listening on IPv6 if bind is an IPv6 address"""
+    class Server(ThreadingHTTPServer):
+        address_family = socket.AF_INET6 if ":" in bind else socket.AF_INET
+    return Server((bind, port), handler)
+
+def make_udp_server(bind, port, handler):
+    class Server(socketserver.ThreadingUDPServer):
+        address_family = socket.AF_INET6 if ":" in bind else socket.AF_INET
+    return Server((bind, port), handler)
+
+def serve_in_thread(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bind", default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="The port for the Cloudflare API stand-in")
+    parser.add_argument("--ipify-port", type=int, default=8081, help="The port for the ipify stand-in. Set to 0 to disable")
+    parser.add_argument("--stun-port", type=int, default=3478, help="The UDP port for the STUN stand-in. Set to 0 to disable")
+    parser.add_argument("--natpmp-port", type=int, default=5351, help="The UDP port for the NAT-PMP/PCP stand-in. Set to 0 to disable")
+    parser.add_argument("--upnp-port", type=int, default=8082, help="The port for the UPnP IGD stand-in. Set to 0 to disable")
+    parser.add_argument("-z", "--zone", action="append", default=[], help="Create a zone with the given name. Can be given multiple times")
+    parser.add_argument("-n", "--records", type=int, default=10, help="Number of hosts (each with an A and an AAAA record) to create per zone, named host0, host1, ...")
+    parser.add_argument("-4", "--ipv4", default="192.0.2.1", help="The IPv4 address served by the ipify stand-in")
+    parser.add_argument("-6", "--ipv6", default="2001:db8::1", help="The IPv6 address served by the ipify stand-in")
+    parser.add_argument("--rate-limit", type=int, default=1200, help="Maximum number of requests per --rate-window. Set to 0 to disable")
+    parser.add_argument("--rate-window", type=float, default=300, help="Rate limit window in seconds")
+    parser.add_argument("--max-per-page", type=int, default=5000, help="Maximum page size for listing records")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay every API response by this many seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Additional random delay between 0 and this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API requests that fail with HTTP 500 (0..1)")
+    args = parser.parse_args()
+
+    state = MockCloudflareState(rate_limit=args.rate_limit, rate_window=args.rate_window, max_per_page=args.max_per_page)
+    for zone_name in args.zone or ["example.com"]:
+        zone_id = state.add_zone(zone_name)
+        for i in range(args.records):
+            state.add_record(zone_id, {"name": f"host{i}.{zone_name}", "type": "A", "content": "192.0.2.254"})
+            state.add_record(zone_id, {"name": f"host{i}.{zone_name}", "type": "AAAA", "content": f"2001:db8:ffff::{i:x}"})
+        logger.info("Created zone", name=zone_name, id=zone_id, records=2 * args.records)
+
+    MockCloudflareHandler.state = state
+    MockCloudflareHandler.latency = args.latency
+    MockCloudflareHandler.jitter = args.jitter
+    MockCloudflareHandler.error_rate = args.error_rate
+    cloudflare_server = make_server(args.bind, args.port, MockCloudflareHandler)
+    MockIpifyHandler.addresses = {"ipv4": args.ipv4, "ipv6": args.ipv6}
+    if args.ipify_port:
+        ipify_server = make_server(args.bind, args.ipify_port, MockIpifyHandler)
+        serve_in_thread(ipify_server)
+        logger.info("Serving ipify stand-in", url=f"http://{args.bind}:{args.ipify_port}/ipv4")
+    if args.stun_port:
+        stun_server = make_udp_server(args.bind, args.stun_port, MockStunHandler)
+        serve_in_thread(stun_server)
+        logger.info("Serving STUN stand-in", address=f"{args.bind}:{args.stun_port}")
+    if args.natpmp_port:
+        natpmp_server = make_udp_server(args.bind, args.natpmp_port, MockNatPmpHandler)
+        serve_in_thread(natpmp_server)
+        logger.info("Serving NAT-PMP/PCP stand-in", address=f"{args.bind}:{args.natpmp_port}")
+    if args.upnp_port:
+        upnp_server = make_server(args.bind, args.upnp_port, MockUpnpHandler)
+        serve_in_thread(upnp_server)
+        logger.info("Serving UPnP IGD stand-in", url=f"http://{args.bind}:{args.upnp_port}/rootDesc.xml")
+    logger.info("Serving Cloudflare API stand-in", url=f"http://{args.bind}:{args.port}{MockCloudflareHandler.prefix}")
+    try:
+        cloudflare_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -2,12 +2,44 @@
 import time
 import argparse
 import sys
+import os
+import json
+import asyncio
+import concurrent.futures
+import threading
+import socket
+import signal
+import struct
+import collections
+import heapq
+import itertools
+import random
+import tempfile
+import copy
+import email.utils
+import urllib.parse
 import structlog
 import logging
 import CloudFlare
 import requests
 import ipaddress
 from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.connection import allowed_gai_family
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NameResolutionError, ConnectTimeoutError, NewConnectionError
+from xml.etree import ElementTree
+try:
+    import numpy as np # Optional, only used to speed up bulk IPv6 renumbering
+except ImportError:
+    np = None
+try:
+    # Optional, only used for --http2 (pip install httpx[http2])
+    import httpx
+    import h2
+except ImportError:
+    httpx = None
 
 logger = structlog.get_logger()
 
@@ -40,143 +72,2594 @@ def replace_ipv6_host_part(net_addr, host_addr, netmask_length=64):
     # Put together resulting IP
     return bitwise_or_ipv6(net_part, host_part)
 
-def get_current_ipv4():
+class IPv6HostTemplate:
+    """
+    A precompiled --ipv6-host rewrite such as ::dead:cafe/64: Keeps the network part
+    (the first prefix length bits) of an address and replaces the rest by the host bits
+    of the template. The spec is parsed once, applying it only needs integer operations.
+    """
+    _cache = {}
+
+    def __init__(self, spec):
+        host_addr_str, _, prefix_length_str = spec.partition("/")
+        if not prefix_length_str or not host_addr_str:
+            raise ValueError(f"You need to specify --ipv6-host with prefix length such as ::dead:cafe/64, not {spec}")
+        self.spec = spec
+        self.prefix_length = int(prefix_length_str)
+        if not 0 <= self.prefix_length <= 128:
+            raise ValueError(f"Invalid prefix length in --ipv6-host {spec}")
+        self.hostmask = (1 << (128 - self.prefix_length)) - 1
+        self.netmask = ((1 << 128) - 1) ^ self.hostmask
+        self.host_bits = int(ipaddress.IPv6Address(host_addr_str)) & self.hostmask
+
+    @classmethod
+    def compile(cls, spec):
+        """Like IPv6HostTemplate(spec), but hosts using the same spec share one instance"""
+        template = cls._cache.get(spec)
+        if template is None:
+            template = cls._cache[spec] = cls(spec)
+        return template
+
+    def apply_int(self, address_int):
+        return (address_int & self.netmask) | self.host_bits
+
+    def apply(self, address):
+        """Apply to an address given as str, IPv6Address or int. Returns the resulting address as str"""
+        if not isinstance(address, int):
+            address = int(ipaddress.IPv6Address(address))
+        return str(ipaddress.IPv6Address(self.apply_int(address)))
+
+    @staticmethod
+    def apply_all(templates, address):
+        """Apply many templates to the same address, which is only parsed once. Returns {template: address str}"""
+        address_int = int(ipaddress.IPv6Address(address))
+        return {template: str(ipaddress.IPv6Address(template.apply_int(address_int))) for template in templates}
+
+def plan_ipv6_renumbering(records, old_prefix, new_prefix):
+    """
+    Find all AAAA records within old_prefix and compute their new address within
+    new_prefix, keeping the host bits. Both prefixes are IPv6Network instances
+    of the same length. Returns an update plan: a list of (record, new content)
+    containing only the records that change.
+    If NumPy is installed, all records are processed in one vectorized pass.
+    """
+    if old_prefix.prefixlen != new_prefix.prefixlen:
+        raise ValueError(f"Can't renumber {old_prefix} to {new_prefix}: prefix lengths differ")
+    # Parse all AAAA records into 16 byte packed addresses
+    aaaa_records = []
+    packed = []
+    for record in records:
+        if record["type"] != "AAAA":
+            continue
+        try:
+            packed.append(socket.inet_pton(socket.AF_INET6, record["content"]))
+        except (OSError, ValueError):
+            continue
+        aaaa_records.append(record)
+    if not aaaa_records:
+        return []
+    netmask = int(old_prefix.netmask)
+    old_network = int(old_prefix.network_address)
+    new_network = int(new_prefix.network_address)
+    if np is None:
+        return _plan_ipv6_renumbering_python(aaaa_records, packed, netmask, old_network, new_network)
+    # Two uint64 words (high, low) per address
+    def words(value):
+        return np.array([value >> 64, value & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64)
+    addresses = np.frombuffer(b"".join(packed), dtype=">u8").astype(np.uint64).reshape(-1, 2)
+    mask = words(netmask)
+    inside = ((addresses & mask) == words(old_network)).all(axis=1)
+    renumbered = (addresses & ~mask) | words(new_network)
+    changed = np.nonzero(inside & (renumbered != addresses).any(axis=1))[0]
+    new_packed = renumbered[changed].astype(">u8").tobytes()
+    return [
+        (aaaa_records[index], socket.inet_ntop(socket.AF_INET6, new_packed[16 * i:16 * i + 16]))
+        for i, index in enumerate(changed.tolist())
+    ]
+
+def _plan_ipv6_renumbering_python(aaaa_records, packed, netmask, old_network, new_network):
+    """Same as plan_ipv6_renumbering() without NumPy"""
+    plan = []
+    for record, address in zip(aaaa_records, packed):
+        address = int.from_bytes(address, "big")
+        if address & netmask != old_network:
+            continue
+        renumbered = (address & ~netmask) | new_network
+        if renumbered != address:
+            plan.append((record, socket.inet_ntop(socket.AF_INET6, renumbered.to_bytes(16, "big"))))
+    return plan
+
+DEFAULT_DISCOVERY_TIMEOUT = 5 # seconds
+IPV4_URL = "https://api4.ipify.org"
+IPV6_URL = "https://api6.ipify.org"
+# Default providers for HTTPDiscovery. All of them are queried concurrently, the first valid answer wins
+# Only single-stack endpoints, a dual-stack provider might answer an IPv4 query with our IPv6 address
+IPV4_URLS = [IPV4_URL, "https://ipv4.icanhazip.com", "https://1.1.1.1/cdn-cgi/trace"]
+IPV6_URLS = [IPV6_URL, "https://ipv6.icanhazip.com", "https://[2606:4700:4700::1111]/cdn-cgi/trace"]
+
+
+def parse_ip_response(text, version):
+    """
+    Extract the address from an IP echo service response. Supports plain text responses
+    (ipify, icanhazip, ifconfig.co) and Cloudflare's /cdn-cgi/trace (ip=... line).
+    Returns None unless the response is a valid address of the given IP version.
+    """
+    text = text.strip()
+    for line in text.splitlines():
+        if line.startswith("ip="):
+            text = line[3:]
+            break
+    try:
+        address = ipaddress.ip_address(text)
+    except ValueError:
+        return None
+    return str(address) if address.version == version else None
+
+class Backoff:
+    """Exponential backoff with jitter: Every delay is between half and the full base * 2^(failures - 1), at most maximum"""
+    def __init__(self, base=5, maximum=600):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+
+    def next_delay(self):
+        self.failures += 1
+        delay = min(self.maximum, self.base * 2 ** min(self.failures - 1, 32))
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.failures = 0
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to an endpoint whose circuit breaker is open"""
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint after failure_threshold consecutive failures.
+    closed: All requests are allowed.
+    open: No requests are allowed until the (exponentially growing, jittered) backoff delay has passed.
+    half-open: A single trial request is allowed. Success closes the breaker, failure opens it again.
+               If the trial has no outcome within trial_timeout seconds, another trial is allowed.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+    CANCELLED_TRIAL_DELAY = 1 # seconds until the next trial if a half-open trial was cancelled
+
+    def __init__(self, name, failure_threshold=3, base_delay=5, max_delay=600, trial_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff = Backoff(base_delay, max_delay)
+        self.trial_timeout = trial_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0
+        self.trial_deadline = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Check if a request may be sent now. In half-open state, only the first caller (per trial_timeout) gets True"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == self.OPEN and now >= self.open_until:
+                self.state = self.HALF_OPEN
+                logger.debug("Circuit breaker half-open, trying again", endpoint=self.name)
+            elif self.state == self.HALF_OPEN and now >= self.trial_deadline:
+                logger.debug("Circuit breaker trial timed out, trying again", endpoint=self.name)
+            else:
+                return False
+            self.trial_deadline = now + self.trial_timeout
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("Endpoint recovered, circuit breaker closed", endpoint=self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.backoff.reset()
+
+    def record_cancelled(self):
+        """The request was cancelled, e.g. because another endpoint answered first. That's neither success nor failure"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                # Allow a new trial soon
+                self.state = self.OPEN
+                self.open_until = time.monotonic() + self.CANCELLED_TRIAL_DELAY
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                delay = self.backoff.next_delay()
+                self.state = self.OPEN
+                self.open_until = time.monotonic() + delay
+                logger.warning("Endpoint failing, circuit breaker open", endpoint=self.name, failures=self.failures, retry_in=round(delay, 1))
+
+class CircuitBreakers:
+    """Thread-safe registry of one CircuitBreaker per endpoint, created on first use"""
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs # Passed to every CircuitBreaker
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(endpoint, **self.kwargs)
+            return self.breakers[endpoint]
+
+async def query_and_record(breaker, query, endpoint):
+    """Await query(endpoint) and record the outcome in breaker (whose allow() has already been called)"""
     try:
-        return requests.get("https://api4.ipify.org", timeout=5).text
-    except requests.exceptions.ConnectionError as ex:
-        logger.error("Failed to find our IPv4 address", exception=str(ex))
+        result = await query(endpoint)
+    except asyncio.CancelledError:
+        breaker.record_cancelled()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    return result
+
+async def race(version, endpoints, breakers, query, description):
+    """
+    Run the coroutine function query(endpoint) concurrently for all endpoints whose circuit breaker allows it
+    and return the first successful result. The other queries are cancelled.
+    Returns None if all queries fail. description is used for logging, e.g. "STUN servers".
+    """
+    allowed = [endpoint for endpoint in endpoints if breakers[endpoint].allow()]
+    if not allowed:
+        logger.error(f"All IPv{version} {description} are failing, waiting for retry", endpoints=endpoints)
         return None
+    tasks = [asyncio.create_task(query_and_record(breakers[endpoint], query, endpoint)) for endpoint in allowed]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                return await next_done
+            except Exception as ex:
+                logger.debug(f"Failed to query IPv{version} {description}", exception=str(ex) or type(ex).__name__)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Let the cancelled queries clean up and record their cancellation
+        await asyncio.gather(*tasks, return_exceptions=True)
+    logger.error(f"Failed to find our IPv{version} address", endpoints=allowed)
+    return None
+
+class HTTPDiscovery:
+    """
+    Get the current public address from HTTP echo services such as ipify.
+    All URLs are queried concurrently and the first valid answer is used,
+    so one slow or broken provider doesn't delay the update.
+    Providers which keep failing are skipped until their circuit breaker allows a retry.
+    Every provider has its own keep-alive session, so the connection (including the TLS handshake)
+    is reused across update cycles. timeout may be a (connect, read) tuple.
+    """
+    def __init__(self, version, urls=None, timeout=DEFAULT_DISCOVERY_TIMEOUT, breakers=None):
+        self.version = version
+        self.urls = urls or (IPV4_URLS if version == 4 else IPV6_URLS)
+        self.timeout = timeout
+        self.breakers = breakers or CircuitBreakers()
+        # One request per provider and cycle, so a single pooled connection is enough
+        self.sessions = {url: make_session(TimeoutHTTPAdapter(timeout=timeout, pool_maxsize=1, max_retries=connect_retries()))
+                         for url in self.urls}
+
+    def query(self, url):
+        response = self.sessions[url].get(url)
+        response.raise_for_status()
+        address = parse_ip_response(response.text, self.version)
+        if address is None:
+            logger.debug(f"Invalid IPv{self.version} response", url=url, response=response.text[:100])
+            raise ValueError(f"Invalid IPv{self.version} response from {url}")
+        return address
+
+    async def discover(self):
+        # The requests of slower providers can't be interrupted, but their results are ignored
+        return await race(self.version, self.urls, self.breakers, lambda url: asyncio.to_thread(self.query, url), "providers")
+
+# STUN (RFC 5389) constants
+STUN_MAGIC_COOKIE = 0x2112A442
+STUN_BINDING_REQUEST = 0x0001
+STUN_BINDING_SUCCESS = 0x0101
+STUN_ATTR_MAPPED_ADDRESS = 0x0001
+STUN_ATTR_XOR_MAPPED_ADDRESS = 0x0020
+STUN_ATTR_XOR_MAPPED_ADDRESS_OLD = 0x8020 # Used by some servers implementing a draft of RFC 5389
+STUN_DEFAULT_PORT = 3478
+STUN_INITIAL_RTO = 0.5 # seconds, doubled on every retransmission
+# Default servers for StunDiscovery. All of them are queried concurrently, the first valid answer wins
+STUN_SERVERS = ["stun.cloudflare.com:3478", "stun.l.google.com:19302", "stun1.l.google.com:19302"]
+
+def stun_binding_request(transaction_id):
+    """Build a STUN Binding Request without attributes"""
+    return struct.pack("!HHI12s", STUN_BINDING_REQUEST, 0, STUN_MAGIC_COOKIE, transaction_id)
+
+def parse_stun_response(data, transaction_id):
+    """
+    Get the mapped address from a STUN Binding Success Response.
+    XOR-MAPPED-ADDRESS is preferred over MAPPED-ADDRESS.
+    Returns None if data is not a valid response to the given transaction.
+    """
+    if len(data) < 20:
+        return None
+    msg_type, length, cookie, response_transaction_id = struct.unpack("!HHI12s", data[:20])
+    if msg_type != STUN_BINDING_SUCCESS or cookie != STUN_MAGIC_COOKIE or response_transaction_id != transaction_id:
+        return None
+    mapped_address = None
+    pos = 20
+    end = min(len(data), 20 + length)
+    while pos + 4 <= end:
+        attr_type, attr_length = struct.unpack("!HH", data[pos:pos + 4])
+        value = data[pos + 4:pos + 4 + attr_length]
+        # Attributes are padded to a multiple of 4 bytes
+        pos += 4 + (attr_length + 3) // 4 * 4
+        if len(value) < 8:
+            continue
+        family = value[1]
+        packed = value[4:8] if family == 0x01 else value[4:20] if family == 0x02 else None
+        if packed is None or len(packed) not in (4, 16):
+            continue
+        if attr_type in (STUN_ATTR_XOR_MAPPED_ADDRESS, STUN_ATTR_XOR_MAPPED_ADDRESS_OLD):
+            key = struct.pack("!I", STUN_MAGIC_COOKIE) + transaction_id
+            packed = bytes(a ^ b for a, b in zip(packed, key))
+            return str(ipaddress.ip_address(packed))
+        if attr_type == STUN_ATTR_MAPPED_ADDRESS:
+            mapped_address = str(ipaddress.ip_address(packed))
+    return mapped_address
+
+def parse_stun_server(server):
+    """Split "host", "host:port" or "[ipv6]:port" into (host, port)"""
+    parts = urllib.parse.urlsplit("//" + server)
+    return parts.hostname, parts.port or STUN_DEFAULT_PORT
+
+class StunProtocol(asyncio.DatagramProtocol):
+    """Receives STUN responses and hands them to the query waiting for the same transaction ID"""
+    def __init__(self):
+        self.waiters = {} # transaction ID => future
+
+    def datagram_received(self, data, addr):
+        future = self.waiters.get(data[8:20])
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable. The query will time out or get a response from a retransmission
+        logger.debug("STUN socket error", exception=str(exc))
+
+class StunDiscovery:
+    """
+    Get the current public address by sending STUN Binding Requests (RFC 5389) via UDP.
+    All servers are queried concurrently from a single socket of the given IP version,
+    the first valid answer is used. This takes a single round trip instead of
+    the TCP & TLS handshakes of HTTPDiscovery.
+    Requests are retransmitted with exponential backoff as UDP packets may be lost.
+    """
+    def __init__(self, version, servers=None, timeout=DEFAULT_DISCOVERY_TIMEOUT, breakers=None):
+        self.version = version
+        self.family = socket.AF_INET if version == 4 else socket.AF_INET6
+        self.servers = servers or STUN_SERVERS
+        self.timeout = timeout
+        self.breakers = breakers or CircuitBreakers()
+
+    async def query(self, transport, protocol, server):
+        loop = asyncio.get_running_loop()
+        host, port = parse_stun_server(server)
+        addrinfo = await loop.getaddrinfo(host, port, family=self.family, type=socket.SOCK_DGRAM)
+        server_address = addrinfo[0][4]
+        transaction_id = os.urandom(12)
+        request = stun_binding_request(transaction_id)
+        future = loop.create_future()
+        protocol.waiters[transaction_id] = future
+        try:
+            rto = STUN_INITIAL_RTO
+            while True:
+                transport.sendto(request, server_address)
+                try:
+                    data = await asyncio.wait_for(asyncio.shield(future), rto)
+                    break
+                except asyncio.TimeoutError:
+                    rto *= 2
+        finally:
+            del protocol.waiters[transaction_id]
+        address = parse_stun_response(data, transaction_id)
+        address = parse_ip_response(address, self.version) if address is not None else None
+        if address is None:
+            raise ValueError(f"Invalid STUN response from {server}")
+        return address
+
+    async def discover(self):
+        loop = asyncio.get_running_loop()
+        try:
+            transport, protocol = await loop.create_datagram_endpoint(StunProtocol, family=self.family)
+        except OSError as ex:
+            logger.error(f"Failed to create IPv{self.version} UDP socket", exception=str(ex))
+            return None
+        try:
+            # A timeout counts as failure of the server
+            return await race(self.version, self.servers, self.breakers,
+                              lambda server: asyncio.wait_for(self.query(transport, protocol, server), self.timeout), "STUN servers")
+        finally:
+            transport.close()
+
+# Default queries for DNSDiscovery, in dig syntax: @nameserver[#port] name [class] [type]
+# The answer is the address the query was sent from
+DNS_QUERIES_V4 = ["@1.1.1.1 whoami.cloudflare CH TXT", "@1.0.0.1 whoami.cloudflare CH TXT",
+                  "@208.67.222.222 myip.opendns.com A", "@216.239.32.10 o-o.myaddr.l.google.com TXT"]
+DNS_QUERIES_V6 = ["@2606:4700:4700::1111 whoami.cloudflare CH TXT", "@2606:4700:4700::1001 whoami.cloudflare CH TXT",
+                  "@2620:119:35::35 myip.opendns.com AAAA", "@2001:4860:4802:32::a o-o.myaddr.l.google.com TXT"]
+
+def parse_dns_query(query):
+    """
+    Parse a query in dig syntax, e.g. "@1.1.1.1 whoami.cloudflare CH TXT" or "@127.0.0.1#5353 myip.example A"
+    into (nameserver, port, name, rdtype, rdclass). Raises ValueError if invalid.
+    """
+    nameserver, port, name, rdtype, rdclass = None, 53, None, "A", "IN"
+    for token in query.split():
+        if token.startswith("@"):
+            nameserver, _, port_str = token[1:].partition("#")
+            port = int(port_str) if port_str else 53
+        elif token.upper() in ("IN", "CH"):
+            rdclass = token.upper()
+        elif token.upper() in ("A", "AAAA", "TXT"):
+            rdtype = token.upper()
+        else:
+            name = token
+    if nameserver is None or name is None:
+        raise ValueError(f"Invalid DNS query {query!r}, use e.g. \"@1.1.1.1 whoami.cloudflare CH TXT\"")
+    ipaddress.ip_address(nameserver) # Raises ValueError if it's not an IP address
+    return nameserver, port, name, rdtype, rdclass
+
+class DNSDiscovery:
+    """
+    Get the current public address using DNS queries answered with the address of the client,
+    like Cloudflare's whoami.cloudflare (CH TXT) or OpenDNS' myip.opendns.com (A/AAAA).
+    That's a single UDP packet per query, and it works where outbound HTTPS is proxied.
+    All queries run concurrently, the first valid answer is used.
+    Every query has its own long-lived resolver (without cache).
+    """
+    def __init__(self, version, queries=None, timeout=DEFAULT_DISCOVERY_TIMEOUT, breakers=None):
+        import dns.asyncresolver # Optional dependency, only needed for this backend
+        self.version = version
+        self.queries = queries or (DNS_QUERIES_V4 if version == 4 else DNS_QUERIES_V6)
+        self.timeout = timeout
+        self.breakers = breakers or CircuitBreakers()
+        self.resolvers = {}
+        self.parsed_queries = {}
+        for query in self.queries:
+            nameserver, port, name, rdtype, rdclass = parse_dns_query(query)
+            resolver = dns.asyncresolver.Resolver(configure=False)
+            resolver.nameservers = [nameserver]
+            resolver.port = port
+            resolver.lifetime = timeout
+            self.resolvers[query] = resolver
+            self.parsed_queries[query] = (name, rdtype, rdclass)
+
+    async def query(self, query):
+        name, rdtype, rdclass = self.parsed_queries[query]
+        answer = await self.resolvers[query].resolve(name, rdtype, rdclass)
+        for rdata in answer:
+            if rdtype == "TXT":
+                address = parse_ip_response(b"".join(rdata.strings).decode("ascii", errors="replace"), self.version)
+            else:
+                address = parse_ip_response(rdata.address, self.version)
+            if address is not None:
+                return address
+        raise ValueError(f"No IPv{self.version} address in DNS answer to {query}")
+
+    async def discover(self):
+        return await race(self.version, self.queries, self.breakers, self.query, "DNS queries")
+
+def default_gateway_ipv4(filename="/proc/net/route"):
+    """Get the IPv4 default gateway from the kernel routing table (Linux only). Returns None if there is none"""
+    with open(filename) as infile:
+        for line in infile.readlines()[1:]:
+            fields = line.split()
+            # Destination 0.0.0.0 with RTF_GATEWAY flag
+            if len(fields) >= 4 and fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                return socket.inet_ntoa(struct.pack("<I", int(fields[2], 16)))
+    return None
+
+class RouterDiscovery:
+    """
+    Base class for asking the local router (NAT gateway) for its external IPv4 address via UDP.
+    The gateway is taken from the default route (or given as "host[:port]") and the
+    socket is kept across update cycles. Both are discovered again after a failure.
+    Requests are retransmitted after 250ms, 500ms, 1s, ... until timeout.
+    """
+    DEFAULT_PORT = 5351
+    INITIAL_RETRANSMIT_TIME = 0.25 # seconds
+
+    def __init__(self, version, gateway=None, timeout=DEFAULT_DISCOVERY_TIMEOUT):
+        if version != 4:
+            raise ValueError(f"{type(self).__name__} only supports IPv4")
+        self.version = version
+        self.configured_gateway = gateway
+        self.timeout = timeout
+        self.gateway = None # (host, port)
+        self.sock = None
+
+    def connect(self):
+        if self.sock is not None:
+            return
+        if self.configured_gateway:
+            parts = urllib.parse.urlsplit("//" + self.configured_gateway)
+            self.gateway = (parts.hostname, parts.port or self.DEFAULT_PORT)
+        else:
+            host = default_gateway_ipv4()
+            if host is None:
+                raise OSError("No IPv4 default gateway")
+            self.gateway = (host, self.DEFAULT_PORT)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Connected UDP socket => ICMP errors are reported and only the gateway's responses are received
+        self.sock.connect(self.gateway)
+        logger.debug("Using gateway", gateway=self.gateway)
+
+    def reset(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def request(self, payload, is_response):
+        """Send payload to the gateway until a response for which is_response(data) is True arrives"""
+        self.connect()
+        deadline = time.monotonic() + self.timeout
+        retransmit_time = self.INITIAL_RETRANSMIT_TIME
+        while True:
+            self.sock.send(payload)
+            retransmit_at = min(deadline, time.monotonic() + retransmit_time)
+            while (remaining := retransmit_at - time.monotonic()) > 0:
+                self.sock.settimeout(remaining)
+                try:
+                    data = self.sock.recv(1100)
+                except socket.timeout:
+                    break
+                if is_response(data):
+                    return data
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"No response from gateway {self.gateway[0]}:{self.gateway[1]}")
+            retransmit_time *= 2
+
+    def query(self):
+        raise NotImplementedError
+
+    def discover(self):
+        try:
+            return self.query()
+        except (OSError, ValueError) as ex:
+            logger.error(f"Failed to get the external IPv{self.version} address from the router", gateway=self.gateway, exception=str(ex))
+            self.reset()
+            return None
+
+class NatPmpDiscovery(RouterDiscovery):
+    """Get the external address using a NAT-PMP (RFC 6886) external address request"""
+    def query(self):
+        response = self.request(struct.pack("!BB", 0, 0), lambda data: len(data) >= 12 and data[:2] == b"\x00\x80")
+        result_code, = struct.unpack("!H", response[2:4])
+        if result_code != 0:
+            raise ValueError(f"NAT-PMP error {result_code}")
+        return socket.inet_ntoa(response[8:12])
+
+PCP_VERSION = 2
+PCP_OPCODE_MAP = 1
+PCP_MAP_LIFETIME = 120 # seconds
+
+def ipv4_mapped(address):
+    """The 16 byte IPv4-mapped IPv6 representation of an IPv4 address as used by PCP"""
+    return ipaddress.IPv6Address("::ffff:" + address).packed
+
+class PcpDiscovery(RouterDiscovery):
+    """
+    Get the external address using PCP (RFC 6887). PCP has no plain "get external address"
+    request, so this requests a short-lived UDP mapping for our (unused) socket port and uses
+    the assigned external address. The same nonce is used for every request, so the router
+    renews a single mapping instead of creating new ones.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.nonce = os.urandom(12)
+
+    def query(self):
+        self.connect()
+        client_address, internal_port = self.sock.getsockname()
+        request = struct.pack("!BBHI16s", PCP_VERSION, PCP_OPCODE_MAP, 0, PCP_MAP_LIFETIME, ipv4_mapped(client_address))
+        request += struct.pack("!12sB3xHH16s", self.nonce, socket.IPPROTO_UDP, internal_port, 0, ipv4_mapped("0.0.0.0"))
+        response = self.request(request, lambda data: len(data) >= 60 and data[0] == PCP_VERSION
+                                and data[1] == 0x80 | PCP_OPCODE_MAP and data[24:36] == self.nonce)
+        if response[3] != 0:
+            raise ValueError(f"PCP error {response[3]}")
+        external_address = ipaddress.IPv6Address(response[44:60])
+        return str(external_address.ipv4_mapped or external_address)
+
+class UpnpDiscovery:
+    """
+    Get the external address using the GetExternalIPAddress action of a UPnP Internet Gateway Device.
+    The device is found via SSDP (or given as description URL) once, and its control URL
+    is kept across update cycles. Both are discovered again after a failure.
+    """
+    SSDP_ADDRESS = ("239.255.255.250", 1900)
+    DEVICE_TYPE = "urn:schemas-upnp-org:device:InternetGatewayDevice:1"
+    SERVICE_TYPES = ["urn:schemas-upnp-org:service:WANIPConnection:2",
+                     "urn:schemas-upnp-org:service:WANIPConnection:1",
+                     "urn:schemas-upnp-org:service:WANPPPConnection:1"]
+
+    def __init__(self, version, location=None, timeout=DEFAULT_DISCOVERY_TIMEOUT):
+        if version != 4:
+            raise ValueError("UpnpDiscovery only supports IPv4")
+        self.version = version
+        self.configured_location = location
+        self.timeout = timeout
+        self.control = None # (control URL, service type)
+        self.session = make_session(TimeoutHTTPAdapter(timeout=timeout, pool_maxsize=1, max_retries=connect_retries()))
+
+    def find_location(self):
+        """Find the device description URL using an SSDP M-SEARCH"""
+        request = "\r\n".join([
+            "M-SEARCH * HTTP/1.1",
+            f"HOST: {self.SSDP_ADDRESS[0]}:{self.SSDP_ADDRESS[1]}",
+            'MAN: "ssdp:discover"',
+            "MX: 2",
+            f"ST: {self.DEVICE_TYPE}",
+            "", ""]).encode("ascii")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            sock.sendto(request, self.SSDP_ADDRESS)
+            deadline = time.monotonic() + self.timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                sock.settimeout(remaining)
+                try:
+                    data, _ = sock.recvfrom(4096)
+                except socket.timeout:
+                    break
+                for line in data.decode("utf-8", errors="replace").splitlines():
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "location":
+                        return value.strip()
+        raise TimeoutError("No UPnP Internet Gateway Device found")
+
+    def find_control_url(self, location):
+        """Get the control URL of the first WAN connection service from the device description"""
+        response = self.session.get(location)
+        response.raise_for_status()
+        root = ElementTree.fromstring(response.content)
+        ns = {"upnp": "urn:schemas-upnp-org:device-1-0"}
+        base_url = root.findtext("upnp:URLBase", default=location, namespaces=ns) or location
+        services = {service.findtext("upnp:serviceType", namespaces=ns): service.findtext("upnp:controlURL", namespaces=ns)
+                    for service in root.iterfind(".//upnp:service", ns)}
+        for service_type in self.SERVICE_TYPES:
+            if services.get(service_type):
+                return urllib.parse.urljoin(base_url, services[service_type]), service_type
+        raise ValueError(f"No WAN connection service found in {location}")
+
+    def query(self):
+        if self.control is None:
+            location = self.configured_location or self.find_location()
+            self.control = self.find_control_url(location)
+            logger.debug("Using UPnP gateway", control_url=self.control[0], service_type=self.control[1])
+        control_url, service_type = self.control
+        body = ('<?xml version="1.0"?>'
+                '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+                f'<s:Body><u:GetExternalIPAddress xmlns:u="{service_type}"/></s:Body></s:Envelope>')
+        response = self.session.post(control_url, data=body, headers={
+            "Content-Type": 'text/xml; charset="utf-8"',
+            "SOAPAction": f'"{service_type}#GetExternalIPAddress"',
+        })
+        response.raise_for_status()
+        for element in ElementTree.fromstring(response.content).iter():
+            if element.tag.endswith("NewExternalIPAddress"):
+                # Empty while the WAN connection is down
+                address = parse_ip_response(element.text or "", self.version)
+                if address is None:
+                    raise ValueError(f"Invalid external address {element.text!r}")
+                return address
+        raise ValueError("No NewExternalIPAddress in response")
+
+    def discover(self):
+        try:
+            return self.query()
+        except (OSError, ValueError, requests.exceptions.RequestException, ElementTree.ParseError) as ex:
+            logger.error(f"Failed to get the external IPv{self.version} address via UPnP", exception=str(ex))
+            self.control = None
+            return None
 
-def get_current_ipv6():
+# Netlink constants from <linux/netlink.h>, <linux/rtnetlink.h> and <linux/if_addr.h>
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+IFA_F_TEMPORARY = 0x01
+IFA_F_DADFAILED = 0x08
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+RT_SCOPE_UNIVERSE = 0
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+InterfaceAddress = collections.namedtuple("InterfaceAddress", ["interface", "address", "prefixlen", "scope", "flags"])
+
+def parse_ifaddrmsg(payload):
+    """Parse the payload of a RTM_NEWADDR/RTM_DELADDR message (ifaddrmsg + attributes) into an InterfaceAddress"""
+    family, prefixlen, flags, scope, index = struct.unpack_from("=BBBBI", payload)
+    attributes = {}
+    offset = 8
+    while offset + 4 <= len(payload):
+        attr_length, attr_type = struct.unpack_from("=HH", payload, offset)
+        if attr_length < 4:
+            break
+        attributes[attr_type] = payload[offset + 4:offset + attr_length]
+        offset += (attr_length + 3) & ~3
+    # The 8 bit flags field can't hold newer flags => IFA_FLAGS has all 32 bits if present
+    if IFA_FLAGS in attributes:
+        flags = struct.unpack("=I", attributes[IFA_FLAGS][:4])[0]
+    # For point-to-point links IFA_ADDRESS is the peer address, IFA_LOCAL the local one
+    packed = attributes.get(IFA_LOCAL) or attributes.get(IFA_ADDRESS)
+    if packed is None:
+        return None
     try:
-        return requests.get("https://api6.ipify.org", timeout=5).text
-    except requests.exceptions.ConnectionError as ex:
-        logger.error("Failed to find our IPv6 address", exception=str(ex))
+        interface = socket.if_indextoname(index)
+    except OSError:
+        interface = str(index)
+    return InterfaceAddress(interface, ipaddress.ip_address(packed), prefixlen, scope, flags)
+
+def netlink_addresses(family):
+    """Dump all addresses of the given family (socket.AF_INET or socket.AF_INET6) using netlink RTM_GETADDR"""
+    addresses = []
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        # nlmsghdr (length, type, flags, sequence, port ID) + ifaddrmsg (family, prefixlen, flags, scope, index)
+        sock.send(struct.pack("=IHHII", 24, RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + struct.pack("=BBBBI", family, 0, 0, 0, 0))
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msg_type = struct.unpack_from("=IH", data, offset)
+                if msg_type == NLMSG_DONE:
+                    return addresses
+                if msg_type == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", data, offset + 16)[0]
+                    raise OSError(-error, "Netlink RTM_GETADDR failed")
+                if msg_type == RTM_NEWADDR:
+                    address = parse_ifaddrmsg(data[offset + 16:offset + length])
+                    if address is not None:
+                        addresses.append(address)
+                offset += (length + 3) & ~3
+
+def proc_ipv6_addresses(filename="/proc/net/if_inet6"):
+    """
+    Read all IPv6 addresses from /proc/net/if_inet6.
+    Only used if netlink is not available. Note that only the lower 8 flag bits are available.
+    """
+    addresses = []
+    with open(filename) as infile:
+        for line in infile:
+            address_hex, _, prefixlen, scope, flags, interface = line.split()
+            addresses.append(InterfaceAddress(
+                interface, ipaddress.IPv6Address(bytes.fromhex(address_hex)),
+                int(prefixlen, 16), int(scope, 16), int(flags, 16)))
+    return addresses
+
+class LocalInterfaceDiscovery:
+    """
+    Get the current address from the addresses assigned to local interfaces,
+    asking the kernel via netlink (or /proc/net/if_inet6 as fallback for IPv6).
+    This is much faster than asking an external service, but only works if the
+    public address is assigned directly to an interface (typically IPv6).
+    """
+    DEFAULT_SKIP_FLAGS = IFA_F_TEMPORARY | IFA_F_DEPRECATED | IFA_F_TENTATIVE | IFA_F_DADFAILED
+
+    def __init__(self, version, interface=None, skip_flags=DEFAULT_SKIP_FLAGS, allow_private=False):
+        self.version = version
+        self.interface = interface
+        self.skip_flags = skip_flags
+        self.allow_private = allow_private
+
+    def addresses(self):
+        """All addresses of our address family (unfiltered)"""
+        try:
+            return netlink_addresses(socket.AF_INET if self.version == 4 else socket.AF_INET6)
+        except (OSError, AttributeError): # AttributeError: No AF_NETLINK on this OS
+            if self.version == 4:
+                raise
+            return proc_ipv6_addresses()
+
+    def is_candidate(self, address):
+        return ((self.interface is None or address.interface == self.interface)
+                and address.scope == RT_SCOPE_UNIVERSE
+                and not address.flags & self.skip_flags
+                and (self.allow_private or address.address.is_global))
+
+    def discover(self):
+        for address in self.addresses():
+            if self.is_candidate(address):
+                return str(address.address)
+        logger.error(f"Failed to find a suitable local IPv{self.version} address", interface=self.interface)
+        return None
+
+class NetlinkWatcher:
+    """
+    Subscribes to the kernel's address & route change notifications (netlink multicast)
+    and sets an asyncio.Event whenever a global address or a default route changes,
+    so that an update can be performed immediately instead of at the next interval.
+    """
+    def __init__(self, event, interface=None):
+        self.event = event
+        self.interface = interface
+        self.sock = None
+
+    def start(self, loop):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE))
+        self.sock.setblocking(False)
+        loop.add_reader(self.sock.fileno(), self.on_readable)
+        logger.debug("Watching for address & route changes")
+        return self
+
+    def close(self, loop):
+        if self.sock is not None:
+            loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    def is_relevant(self, msg_type, payload):
+        if msg_type in (RTM_NEWADDR, RTM_DELADDR):
+            address = parse_ifaddrmsg(payload)
+            return (address is not None and address.scope == RT_SCOPE_UNIVERSE
+                    and (self.interface is None or address.interface == self.interface))
+        if msg_type in (RTM_NEWROUTE, RTM_DELROUTE):
+            # rtmsg: family, dst_len, ... => Only default routes (dst_len 0) are relevant
+            return len(payload) >= 2 and payload[1] == 0
+        return False
+
+    def on_readable(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            except OSError as ex: # e.g. ENOBUFS if we missed messages => assume something changed
+                logger.warning("Netlink receive failed", exception=str(ex))
+                self.event.set()
+                return
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msg_type = struct.unpack_from("=IH", data, offset)
+                if length < 16:
+                    break
+                if self.is_relevant(msg_type, data[offset + 16:offset + length]):
+                    logger.debug("Relevant network change", msg_type=msg_type)
+                    self.event.set()
+                offset += (length + 3) & ~3
+
+def make_discovery(version, source="http", urls=None, interface=None, stun_servers=None, dns_queries=None, gateway=None, allow_private=False,
+                   timeout=DEFAULT_DISCOVERY_TIMEOUT, http_timeout=DEFAULT_DISCOVERY_TIMEOUT):
+    """
+    Create the discovery backend for the given IP version (4 or 6).
+    timeout applies to STUN, DNS and router queries, http_timeout (may be a (connect, read) tuple) to HTTP requests
+    """
+    if source == "local":
+        return LocalInterfaceDiscovery(version, interface=interface, allow_private=allow_private)
+    if source == "stun":
+        return StunDiscovery(version, servers=stun_servers, timeout=timeout)
+    if source == "dns":
+        return DNSDiscovery(version, queries=dns_queries, timeout=timeout)
+    if source == "natpmp":
+        return NatPmpDiscovery(version, gateway=gateway, timeout=timeout)
+    if source == "pcp":
+        return PcpDiscovery(version, gateway=gateway, timeout=timeout)
+    if source == "upnp":
+        return UpnpDiscovery(version, location=gateway, timeout=timeout)
+    return HTTPDiscovery(version, urls=urls, timeout=http_timeout)
+
+class ConsensusDiscovery:
+    """
+    Combines one or more discovery sources (name => blocking or async function returning an address)
+    and only trusts addresses that are
+    - valid addresses of our IP version (not e.g. a captive portal page)
+    - public, i.e. not private/reserved/CGNAT (unless allow_private is True)
+    - reported by at least quorum sources (all sources are queried concurrently)
+    - reported in confirmations consecutive cycles if they differ from the last accepted address,
+      so a transient wrong address (e.g. a VPN exit) isn't published and reverted right after.
+    Returns None while there is no trusted address.
+    """
+    def __init__(self, version, sources, quorum=1, confirmations=1, allow_private=False):
+        if quorum > len(sources):
+            raise ValueError(f"Quorum {quorum} is larger than the number of IPv{version} sources ({len(sources)})")
+        self.version = version
+        self.sources = sources
+        self.quorum = quorum
+        self.confirmations = confirmations
+        self.allow_private = allow_private
+        self.accepted = None # Last trusted address
+        self.candidate = None # A new address waiting for confirmation
+        self.candidate_count = 0
+
+    def validate(self, address, source):
+        """Return the normalized address if it can be trusted, None otherwise"""
+        try:
+            parsed = ipaddress.ip_address(address.strip())
+        except (ValueError, AttributeError):
+            logger.warning(f"Ignoring invalid IPv{self.version} address", source=source, response=str(address)[:100])
+            return None
+        if parsed.version != self.version:
+            logger.warning(f"Ignoring address that is not IPv{self.version}", source=source, ip=str(parsed))
+            return None
+        if not self.allow_private and not parsed.is_global:
+            logger.warning("Ignoring non-public address, use --allow-private to accept it", source=source, ip=str(parsed))
+            return None
+        return str(parsed)
+
+    async def query(self, source, discover):
+        try:
+            if asyncio.iscoroutinefunction(discover):
+                address = await discover()
+            else:
+                address = await asyncio.to_thread(discover)
+        except Exception as ex:
+            logger.error(f"Failed to query IPv{self.version} source", source=source, exception=str(ex))
+            return source, None
+        return source, None if address is None else self.validate(address, source)
+
+    async def vote(self):
+        """Query all sources until an address has quorum votes. Returns None if none has"""
+        tasks = [asyncio.create_task(self.query(source, discover)) for source, discover in self.sources.items()]
+        votes = collections.Counter()
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                source, address = await next_done
+                if address is None:
+                    continue
+                votes[address] += 1
+                if votes[address] >= self.quorum:
+                    return address
+        finally:
+            for task in tasks:
+                task.cancel()
+        logger.warning(f"No IPv{self.version} address reached the quorum", quorum=self.quorum, votes=dict(votes))
         return None
 
+    def state(self):
+        """The unconfirmed address change for StateFile, so confirmations work across one-shot runs (--interval 0)"""
+        return {"candidate": self.candidate, "count": self.candidate_count} if self.candidate is not None else None
+
+    def restore(self, state):
+        if state:
+            self.candidate, self.candidate_count = state["candidate"], state["count"]
 
-def check_and_perform_ipv4_update(cf, hostname, zone_id, current_ipv4):
-    a_record = cf.zones.dns_records.get(zone_id, params={"name": hostname, "type": "A"})[0]
+    def confirm(self, address):
+        """Accept address if it is known or has been seen in enough consecutive cycles"""
+        if self.accepted is None or address == self.accepted or self.confirmations <= 1:
+            self.accepted = address
+            self.candidate, self.candidate_count = None, 0
+            return address
+        if address == self.candidate:
+            self.candidate_count += 1
+        else:
+            self.candidate, self.candidate_count = address, 1
+        if self.candidate_count < self.confirmations:
+            logger.info(f"IPv{self.version} address change not confirmed yet", old=self.accepted, new=address,
+                        seen=self.candidate_count, needed=self.confirmations)
+            return None
+        logger.info(f"IPv{self.version} address change confirmed", old=self.accepted, new=address)
+        self.accepted = address
+        self.candidate, self.candidate_count = None, 0
+        return address
 
-    # Check if we need to update
-    need_to_update_a_record = a_record["content"] != current_ipv4
+    async def discover(self):
+        address = await self.vote()
+        if address is None:
+            # Don't count towards confirmations: A change has to be seen in consecutive cycles
+            self.candidate, self.candidate_count = None, 0
+            return None
+        return self.confirm(address)
 
-    # Update A record
-    if need_to_update_a_record:
-        old_ip = a_record["content"]
-        a_record["content"] = current_ipv4
-        cf.zones.dns_records.put(zone_id, a_record["id"], data=a_record)
-        logger.info("Updated IPv4 DNS record", old=old_ip, new=current_ipv4, hostname=hostname)
+RECORDS_PER_PAGE = 5000
+
+def raw_endpoint(endpoint):
+    """
+    Copy of a python-cloudflare endpoint (e.g. cf.zones.dns_records) returning raw responses,
+    i.e. {"result": ..., "result_info": ...}. The client only supports raw mode for all endpoints at once
+    """
+    base = copy.copy(endpoint._base)
+    base.raw = True
+    raw = copy.copy(endpoint)
+    raw._base = base
+    raw._do = getattr(base, endpoint._do.__name__)
+    return raw
+
+class ZoneSnapshot:
+    """
+    In-memory copy of all DNS records of a zone, indexed by ID and by (name, type).
+
+    The zone is listed once and then re-listed only after max_age seconds
+    (reconciliation) or after being invalidated, e.g. when an update failed.
+    In between, checking whether a record is up-to-date costs no API call.
+    """
+    def __init__(self, cf, zone_id, max_age=3600):
+        self.cf = cf
+        self.zone_id = zone_id
+        self.max_age = max_age
+        self.records = {} # (name, type) => record
+        self.by_id = {} # record ID => record
+        self.fetched_at = None
+        # (name, type) of records that were looked up but don't exist
+        self.missing = set()
+        # Hosts are updated from multiple threads => only refresh once
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at > self.max_age
+
+    def invalidate(self):
+        """Force a refresh on the next access"""
+        self.fetched_at = None
+
+    def load(self, records, fetched_at):
+        """Replace the snapshot content by the given list of records"""
+        self.by_id = {record["id"]: record for record in records}
+        self.records = {}
+        for record in records:
+            # Keep the first record if there are multiple records with the same name & type
+            self.records.setdefault((record["name"], record["type"]), record)
+        self.missing.difference_update(self.records)
+        self.fetched_at = fetched_at
+
+    def refresh(self):
+        records = []
+        page = 1
+        # The server may use a smaller page size than requested, so rely on result_info
+        endpoint = raw_endpoint(self.cf.zones.dns_records)
+        while True:
+            response = endpoint.get(self.zone_id, params={"page": page, "per_page": RECORDS_PER_PAGE})
+            records += response["result"]
+            total_pages = (response.get("result_info") or {}).get("total_pages")
+            if not response["result"] or (total_pages is not None and page >= total_pages):
+                break
+            page += 1
+        self.load(records, time.time())
+        logger.debug("Refreshed zone snapshot", zone_id=self.zone_id, records=len(records), pages=page)
+
+    def ensure_fresh(self):
+        """Refresh the snapshot if it is stale"""
+        with self.lock:
+            if self.is_stale():
+                self.refresh()
+
+    def get(self, name, record_type):
+        """Get the record with the given name & type or None if it doesn't exist"""
+        self.ensure_fresh()
+        return self.records.get((name, record_type))
+
+    def report_missing(self, name, record_type):
+        """
+        Invalidate the snapshot the first time a record is found to be missing, as it might have been
+        created after the snapshot was taken. Records which are still missing after that are only
+        looked for again at the next regular refresh, so a misconfigured hostname doesn't cause a refresh on every update.
+        """
+        key = (name, record_type)
+        if key not in self.missing:
+            self.missing.add(key)
+            self.invalidate()
+
+    def set(self, record):
+        """Remember a record after it has been updated"""
+        self.by_id[record["id"]] = record
+        key = (record["name"], record["type"])
+        if key not in self.records or self.records[key]["id"] == record["id"]:
+            self.records[key] = record
+
+STATE_VERSION = 1
+
+class StateFile:
+    """
+    Persistent last-known state: zone IDs, zone snapshots (record IDs & content),
+    the last discovered IPs, the IPv6 prefix tracked by PrefixRenumbering,
+    address changes waiting for confirmation (see ConsensusDiscovery) and the Hysteresis of every host. Loading it at startup means that a restart or a
+    one-shot run (--interval 0) doesn't need any Cloudflare API call if the IP is unchanged.
+    The file is written atomically (temporary file + rename), and only if something changed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {"version": STATE_VERSION, "zone_ids": {}, "zones": {}, "last_ips": {}, "renumber_prefix": None, "candidates": {}, "hysteresis": {}}
+
+    def load(self):
+        try:
+            with open(self.filename) as infile:
+                data = json.load(infile)
+        except FileNotFoundError:
+            return
+        except ValueError as ex:
+            logger.warning("Ignoring corrupt state file", filename=self.filename, exception=str(ex))
+            return
+        if data.get("version") != STATE_VERSION:
+            logger.warning("Ignoring state file with unsupported version", filename=self.filename, version=data.get("version"))
+            return
+        self.data = data
+        logger.debug("Loaded state file", filename=self.filename, zones=len(data["zones"]))
+
+    @property
+    def zone_ids(self):
+        return self.data["zone_ids"]
+
+    @property
+    def last_ips(self):
+        return self.data["last_ips"]
+
+    @property
+    def renumber_prefix(self):
+        return self.data.get("renumber_prefix")
+
+    @property
+    def candidates(self):
+        """IP version ("4"/"6") => ConsensusDiscovery.state()"""
+        return self.data.get("candidates", {})
+
+    @property
+    def hysteresis(self):
+        """Hostname => Hysteresis.state()"""
+        return self.data.get("hysteresis", {})
+
+    def restore_snapshot(self, snapshot):
+        """Initialize snapshot from the saved state, if any"""
+        saved = self.data["zones"].get(snapshot.zone_id)
+        if saved is not None:
+            snapshot.load(saved["records"], saved["fetched_at"])
+
+    def update(self, zone_ids, snapshots, last_ips, renumber_prefix=None, candidates=None, hysteresis=None):
+        """
+        Save the given state if it differs from the previously saved state.
+        candidates maps IP versions to ConsensusDiscovery.state(), hysteresis hostnames
+        to Hysteresis.state() (None => keep the saved ones)
+        """
+        data = {
+            "version": STATE_VERSION,
+            "zone_ids": dict(zone_ids),
+            "zones": {
+                zone_id: {"fetched_at": snapshot.fetched_at, "records": list(snapshot.by_id.values())}
+                for zone_id, snapshot in snapshots.items()
+            },
+            "last_ips": {str(version): ip for version, ip in last_ips.items() if ip is not None},
+            "renumber_prefix": str(renumber_prefix) if renumber_prefix is not None else self.renumber_prefix,
+            "candidates": self.candidates if candidates is None else {
+                str(version): candidate for version, candidate in candidates.items() if candidate is not None
+            },
+            "hysteresis": self.hysteresis if hysteresis is None else {
+                hostname: state for hostname, state in hysteresis.items() if state is not None
+            },
+        }
+        # Keep IPs we didn't discover this time
+        data["last_ips"] = dict(self.data["last_ips"], **data["last_ips"])
+        if data != self.data:
+            self.data = data
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        with tempfile.NamedTemporaryFile("w", dir=directory, prefix=".flaredns-state-", delete=False) as outfile:
+            json.dump(self.data, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(outfile.name, self.filename)
+        logger.debug("Saved state file", filename=self.filename)
+
+RECORD_TYPE_FAMILY = {"A": "IPv4", "AAAA": "IPv6"}
+
+def find_record(cf, hostname, zone_id, record_type, snapshot=None):
+    """
+    Get the current record of the given type.
+    If snapshot is given, the record is taken from the zone snapshot
+    instead of being fetched from the API.
+    """
+    if snapshot is None:
+        return cf.zones.dns_records.get(zone_id, params={"name": hostname, "type": record_type})[0]
+    record = snapshot.get(hostname, record_type)
+    if record is None:
+        snapshot.report_missing(hostname, record_type)
+        raise Exception(f"Could not find {record_type} record for {hostname}")
+    return dict(record)
+
+# Cloudflare API error code ("Record does not exist.") meaning that a cached record ID is outdated (record deleted or replaced).
+# CloudFlareAPIError only carries the API error code, not the HTTP status
+RECORD_NOT_FOUND_ERROR_CODE = 81044
+
+def patch_record(cf, zone_id, record, data, snapshot=None):
+    """
+    PATCH only the fields in data of a record identified by its cached ID, without reading it first.
+    Only if the record ID is outdated (RECORD_NOT_FOUND_ERROR_CODE), the record is looked up by name & type and patched again.
+    Returns the updated record.
+    """
+    try:
+        cf.zones.dns_records.patch(zone_id, record["id"], data=data)
+        return dict(record, **data)
+    except CloudFlare.exceptions.CloudFlareAPIError as ex:
+        if int(ex) != RECORD_NOT_FOUND_ERROR_CODE:
+            raise
+        # Record has been deleted or recreated => re-list zone next time
+        if snapshot is not None:
+            snapshot.invalidate()
+        logger.info("Cached record ID is outdated, looking up record", hostname=record["name"], type=record["type"], record_id=record["id"])
+        records = cf.zones.dns_records.get(zone_id, params={"name": record["name"], "type": record["type"]})
+        if not records:
+            raise
+        cf.zones.dns_records.patch(zone_id, records[0]["id"], data=data)
+        return dict(records[0], **data)
+
+def queue_update(cf, pending, hostname, zone_id, record_type, content, snapshot=None, hysteresis=None):
+    """
+    Update the record of the given type to content if it differs, but only add the change to pending (a PendingUpdates instance).
+    If hysteresis (a Hysteresis instance) is given, it decides whether the change is published now.
+    """
+    family = RECORD_TYPE_FAMILY.get(record_type, record_type)
+    record = find_record(cf, hostname, zone_id, record_type, snapshot)
+    if record["content"] != content:
+        if hysteresis is not None and not hysteresis.allow(hostname, record_type, record["content"], content):
+            return
+        pending.patch(zone_id, record, {"content": content}, log_message=f"Updated {family} DNS record")
     else:
-        logger.debug("IPv4 record already up-to-date", ip=current_ipv4, hostname=hostname)
+        if hysteresis is not None:
+            hysteresis.settle(hostname, record_type, content)
+        logger.debug(f"{family} record already up-to-date", ip=content, hostname=hostname)
+
+# Maximum number of changes per batch request. Cloudflare's limit depends on the plan, 200 works for all plans
+BATCH_MAX_CHANGES = 200
+
+def dns_records_batch(cf):
+    """The batch endpoint is unknown to older python-cloudflare versions, so register it on demand"""
+    try:
+        return cf.zones.dns_records.batch
+    except AttributeError:
+        cf.add("AUTH", "zones", "dns_records/batch")
+        return cf.zones.dns_records.batch
 
-def check_and_perform_ipv6_update(cf, hostname, zone_id, current_ipv6):
-    aaaa_record = cf.zones.dns_records.get(zone_id, params={"name": hostname, "type": "AAAA"})[0]
+def is_record_error(ex):
+    """
+    True if the CloudFlareAPIError ex is caused by an invalid change (DNS validation error, unknown record),
+    False for network errors (code 0), rate limiting, authentication and server errors
+    """
+    code = int(ex)
+    return code == 400 or code == 1004 or 81000 <= code < 82000
 
-    # Check if we need to update
-    need_to_update_aaaa_record = aaaa_record["content"] != current_ipv6
+class PendingUpdates:
+    """
+    Collects record changes per zone during an update cycle and submits them with
+    a single request per zone to the /zones/{id}/dns_records/batch endpoint.
+    If a batch is rejected because of an invalid change, its changes are retried one by one
+    using the individual endpoints. Other failures fail the whole batch (and are retried later).
+    A later change of the same record replaces an earlier one.
+    """
+    OPERATIONS = ("deletes", "patches", "puts", "posts")
 
-    # Update AAAA record
-    if need_to_update_aaaa_record:
-        old_ip = aaaa_record["content"]
-        aaaa_record["content"] = current_ipv6
-        cf.zones.dns_records.put(zone_id, aaaa_record["id"], data=aaaa_record)
-        logger.info("Updated IPv6 DNS record", old=old_ip, new=current_ipv6, hostname=hostname)
+    def __init__(self):
+        self.changes = {} # zone ID => list of (operation, record, data, log_message)
+        self.positions = {} # zone ID => {record ID => index in self.changes[zone ID]}
+        # Changes are queued from multiple threads
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(changes) for changes in self.changes.values())
+
+    def _add(self, zone_id, operation, record, data, log_message):
+        change = (operation, record, data, log_message)
+        with self.lock:
+            changes = self.changes.setdefault(zone_id, [])
+            positions = self.positions.setdefault(zone_id, {})
+            if record is not None and record["id"] in positions:
+                changes[positions[record["id"]]] = change
+                return
+            if record is not None:
+                positions[record["id"]] = len(changes)
+            changes.append(change)
+
+    def patch(self, zone_id, record, data, log_message="Updated DNS record"):
+        """Change only the fields in data of the existing record"""
+        self._add(zone_id, "patches", record, data, log_message)
+
+    def put(self, zone_id, record, data, log_message="Updated DNS record"):
+        """Overwrite the existing record with data"""
+        self._add(zone_id, "puts", record, data, log_message)
+
+    def post(self, zone_id, data, log_message="Created DNS record"):
+        self._add(zone_id, "posts", None, data, log_message)
+
+    def delete(self, zone_id, record, log_message="Deleted DNS record"):
+        self._add(zone_id, "deletes", record, None, log_message)
+
+    def submit(self, cf, snapshots=None):
+        """Submit all pending changes and clear the queue. Returns the number of failed changes"""
+        snapshots = snapshots or {}
+        return sum(self.submit_zone(cf, zone_id, snapshots.get(zone_id)) for zone_id in list(self.changes))
+
+    def submit_zone(self, cf, zone_id, snapshot=None):
+        """Submit and remove the pending changes of a single zone. Returns the number of failed changes"""
+        with self.lock:
+            changes = self.changes.pop(zone_id, [])
+            self.positions.pop(zone_id, None)
+        failed = 0
+        for start in range(0, len(changes), BATCH_MAX_CHANGES):
+            chunk = changes[start:start + BATCH_MAX_CHANGES]
+            try:
+                self._submit_batch(cf, zone_id, chunk)
+            except CloudFlare.exceptions.CloudFlareAPIError as ex:
+                if not is_record_error(ex):
+                    # Individual updates would fail the same way => don't try the remaining chunks either
+                    logger.error("Batch update failed", zone_id=zone_id, changes=len(changes) - start, exception=str(ex))
+                    return failed + len(changes) - start
+                logger.warning("Batch update failed, falling back to individual updates", zone_id=zone_id, changes=len(chunk), exception=str(ex))
+                failed += self._submit_individually(cf, zone_id, chunk, snapshot)
+            else:
+                for change in chunk:
+                    self._applied(zone_id, change, snapshot)
+        return failed
+
+    def _submit_batch(self, cf, zone_id, chunk):
+        payload = {operation: [] for operation in self.OPERATIONS}
+        for operation, record, data, _ in chunk:
+            if operation == "posts":
+                payload["posts"].append(data)
+            elif operation == "deletes":
+                payload["deletes"].append({"id": record["id"]})
+            else:
+                payload[operation].append(dict(data, id=record["id"]))
+        # Don't send empty lists
+        payload = {operation: entries for operation, entries in payload.items() if entries}
+        dns_records_batch(cf).post(zone_id, data=payload)
+        logger.debug("Submitted batch update", zone_id=zone_id, changes=len(chunk))
+
+    def _submit_individually(self, cf, zone_id, chunk, snapshot):
+        failed = 0
+        for change in chunk:
+            operation, record, data, _ = change
+            new_record = None
+            try:
+                if operation == "patches":
+                    new_record = patch_record(cf, zone_id, record, data, snapshot)
+                elif operation == "puts":
+                    cf.zones.dns_records.put(zone_id, record["id"], data=data)
+                elif operation == "posts":
+                    cf.zones.dns_records.post(zone_id, data=data)
+                else:
+                    cf.zones.dns_records.delete(zone_id, record["id"])
+            except CloudFlare.exceptions.CloudFlareAPIError as ex:
+                # Record might have been deleted or changed => re-list zone next time
+                if snapshot is not None:
+                    snapshot.invalidate()
+                logger.exception(ex)
+                failed += 1
+            else:
+                self._applied(zone_id, change, snapshot, new_record)
+        return failed
+
+    def _applied(self, zone_id, change, snapshot, new_record=None):
+        operation, record, data, log_message = change
+        if operation == "posts" or operation == "deletes":
+            # We don't know the new record ID / deletion isn't tracked => re-list zone next time
+            if snapshot is not None:
+                snapshot.invalidate()
+            logger.info(log_message, zone_id=zone_id, hostname=(data or record).get("name"))
+            return
+        if new_record is None:
+            new_record = dict(record, **data) if operation == "patches" else dict(data, id=record["id"])
+        if snapshot is not None:
+            snapshot.set(new_record)
+        logger.info(log_message, old=record.get("content"), new=new_record.get("content"), hostname=new_record.get("name"))
+
+# With adaptive intervals, the interval grows by this factor after every update without address change
+ADAPTIVE_INTERVAL_GROWTH = 2
+
+class Hysteresis:
+    """
+    Limits how often the records of a host are changed on unstable connections.
+    min_dwell: A new address is only published once it has been seen for this many seconds.
+               If the address changes back (A => B => A) within that time, nothing is updated.
+    max_updates: At most this many record changes per window seconds (0 => unlimited).
+    Postponed changes are retried at deferred_until (a time.monotonic() timestamp).
+    A change only counts (and stops being pending) once the record is seen with the new content,
+    so a failed update is retried without waiting for min_dwell again.
+    """
+    def __init__(self, min_dwell=0, max_updates=0, window=3600):
+        self.min_dwell = min_dwell
+        self.max_updates = max_updates
+        self.window = window
+        # record type => (new content, time.monotonic() when first seen, time.monotonic() of the last update attempt or None)
+        self.pending = {}
+        self.updates = collections.deque() # time.monotonic() of recent changes
+        self.deferred_until = None
+
+    def defer(self, until):
+        self.deferred_until = until if self.deferred_until is None else min(self.deferred_until, until)
+
+    def _confirm(self, record_type, published):
+        """Count the pending change as done if the record has been updated to it"""
+        pending_content, _, attempted_at = self.pending.get(record_type, (None, None, None))
+        if attempted_at is not None and pending_content == published:
+            self.updates.append(attempted_at)
+            del self.pending[record_type]
+            return True
+        return False
+
+    def allow(self, hostname, record_type, published, content):
+        """Check if the record may be changed from published to content now"""
+        now = time.monotonic()
+        self._confirm(record_type, published)
+        pending_content, first_seen, _ = self.pending.get(record_type, (None, None, None))
+        if pending_content != content:
+            if pending_content is not None:
+                logger.info("Address changed again before being published", hostname=hostname, type=record_type, previous=pending_content, new=content)
+            first_seen = now
+            self.pending[record_type] = (content, now, None)
+        if now - first_seen < self.min_dwell:
+            logger.debug("Waiting for the new address to be stable", hostname=hostname, type=record_type, new=content,
+                         remaining=round(first_seen + self.min_dwell - now, 1))
+            self.defer(first_seen + self.min_dwell)
+            return False
+        while self.updates and self.updates[0] <= now - self.window:
+            self.updates.popleft()
+        if self.max_updates and len(self.updates) >= self.max_updates:
+            logger.warning("Too many updates, postponing", hostname=hostname, type=record_type, old=published, new=content,
+                           max_updates=self.max_updates, window=self.window)
+            self.defer(self.updates[0] + self.window)
+            return False
+        self.pending[record_type] = (content, first_seen, now)
+        return True
+
+    def settle(self, hostname, record_type, published):
+        """The record already has the current address => The pending change is done, or dropped (A => B => A oscillation)"""
+        if self._confirm(record_type, published):
+            return
+        pending = self.pending.pop(record_type, None)
+        if pending is not None:
+            logger.info("Address changed back before being published, nothing to update", hostname=hostname, type=record_type, ignored=pending[0])
+
+    def state(self):
+        """Pending changes and recent updates for StateFile (with wall clock times), None if there are none"""
+        if not self.pending and not self.updates:
+            return None
+        offset = time.time() - time.monotonic()
+        return {
+            "pending": {record_type: [content, round(first_seen + offset, 1), None if attempted_at is None else round(attempted_at + offset, 1)]
+                        for record_type, (content, first_seen, attempted_at) in self.pending.items()},
+            "updates": [round(update + offset, 1) for update in self.updates],
+        }
+
+    def restore(self, state):
+        """Restore state(), e.g. so --min-dwell works across one-shot runs (--interval 0)"""
+        if not state:
+            return
+        offset = time.time() - time.monotonic()
+        self.pending = {record_type: (content, first_seen - offset, None if attempted_at is None else attempted_at - offset)
+                        for record_type, (content, first_seen, attempted_at) in state["pending"].items()}
+        self.updates = collections.deque(update - offset for update in state["updates"])
+
+    def pop_retry_delay(self):
+        """Seconds until postponed changes should be retried (None if there are none)"""
+        if self.deferred_until is None:
+            return None
+        delay = max(0, self.deferred_until - time.monotonic())
+        self.deferred_until = None
+        return delay
+
+class Host:
+    """
+    A hostname whose A and/or AAAA records are kept up-to-date.
+    If max_interval is larger than interval, the update interval adapts: It grows geometrically
+    up to max_interval while the address is stable and falls back to interval on any change or error.
+    """
+    def __init__(self, hostname, ipv4=False, ipv6=False, ipv6_host=None, interval=60, zone=None, max_interval=None):
+        self.hostname = hostname
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+        self.ipv6_host = ipv6_host
+        # Parse --ipv6-host only once
+        self.ipv6_template = IPv6HostTemplate.compile(ipv6_host) if ipv6_host is not None else None
+        self.interval = interval
+        self.max_interval = max(interval, max_interval or 0)
+        self.current_interval = interval
+        self.last_addresses = None
+        self.hysteresis = Hysteresis()
+        # Retries after failed updates
+        self.backoff = Backoff(RETRY_BASE_DELAY)
+        # Extract domain from hostname: "test.mydomain.com" => mydomain.com
+        self.domain = zone or ".".join(hostname.split(".")[-2:])
+        # time.monotonic() deadline of the next update, managed by Scheduler. 0 => update immediately
+        self.next_update = 0
+
+    def adapt_interval(self, current_ipv4, current_ipv6, failed=False):
+        """Update current_interval after an update cycle with the given discovered addresses"""
+        addresses = (current_ipv4 if self.ipv4 else None, current_ipv6 if self.ipv6 else None)
+        if failed or addresses != self.last_addresses:
+            interval = self.interval
+        else:
+            interval = min(self.max_interval, self.current_interval * ADAPTIVE_INTERVAL_GROWTH)
+        if interval != self.current_interval:
+            logger.debug("Changing update interval", hostname=self.hostname, interval=interval)
+        self.current_interval = interval
+        self.last_addresses = addresses
+
+def load_config(filename):
+    """
+    Load a FlareDNS config file. The format is chosen by file extension:
+    .yaml/.yml (requires PyYAML), .toml or .json
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in (".yaml", ".yml"):
+        import yaml # Only required when using YAML config files
+        with open(filename) as infile:
+            return yaml.safe_load(infile) or {}
+    elif extension == ".toml":
+        import tomllib # Python 3.11+
+        with open(filename, "rb") as infile:
+            return tomllib.load(infile)
     else:
-        logger.debug("IPv6 record already up-to-date", ip=current_ipv6, hostname=hostname)
+        with open(filename) as infile:
+            return json.load(infile)
+
+def hosts_from_config(config, default_interval=60, default_max_interval=None):
+    """
+    Create Host instances from the "hosts" list of a config file.
+    ipv4, ipv6, ipv6_host and interval default to the top-level config values.
+    """
+    hosts = []
+    for entry in config.get("hosts", []):
+        if isinstance(entry, str): # Short form: just the hostname
+            entry = {"hostname": entry}
+        hosts.append(Host(
+            entry["hostname"],
+            ipv4=entry.get("ipv4", config.get("ipv4", False)),
+            ipv6=entry.get("ipv6", config.get("ipv6", False)),
+            ipv6_host=entry.get("ipv6_host", config.get("ipv6_host")),
+            interval=entry.get("interval", config.get("interval", default_interval)),
+            zone=entry.get("zone"),
+            max_interval=entry.get("max_interval", default_max_interval),
+        ))
+    return hosts
+
+def lookup_zone_ids(cf, domains, known=None):
+    """
+    Get the zone ID for every domain. This is done only once and it's assumed to not change.
+    Domains in known (domain => zone ID, e.g. from the state file) are not looked up again.
+    """
+    zone_ids = {}
+    for domain in sorted(set(domains)):
+        if known and domain in known:
+            zone_ids[domain] = known[domain]
+            continue
+        zones = cf.zones.get(params={"name": domain})
+        if len(zones) == 0:
+            raise KeyError(domain)
+        zone_ids[domain] = zones[0]["id"]
+    return zone_ids
+
+class PrefixRenumbering:
+    """
+    Tracks the delegated IPv6 prefix, i.e. the first prefix_length bits of the discovered
+    IPv6 address. When it changes, every AAAA record in the given zones that is still
+    within the old prefix is rewritten to the new prefix, keeping its host bits.
+    prefix is the tracked prefix saved in the state file (e.g. "2001:db8:0:100::/56"),
+    last_ipv6 is used instead for state files without it.
+    """
+    def __init__(self, prefix_length, zone_ids, last_ipv6=None, prefix=None):
+        self.prefix_length = prefix_length
+        self.zone_ids = zone_ids
+        self.prefix = None
+        if prefix:
+            self.prefix = self.prefix_of(ipaddress.IPv6Network(prefix).network_address)
+        elif last_ipv6:
+            self.prefix = self.prefix_of(last_ipv6)
+
+    def prefix_of(self, address):
+        return ipaddress.IPv6Network(f"{address}/{self.prefix_length}", strict=False)
+
+    def check(self, current_ipv6):
+        """
+        Returns the new prefix if it differs from the tracked prefix, None otherwise.
+        The tracked prefix is only updated by complete(), i.e. after all renumbered
+        records have been submitted, so a failed renumbering is retried.
+        """
+        prefix = self.prefix_of(current_ipv6)
+        if self.prefix is None:
+            self.prefix = prefix
+            return None
+        if prefix == self.prefix:
+            return None
+        logger.info("IPv6 prefix changed", old=str(self.prefix), new=str(prefix))
+        return prefix
+
+    def queue(self, cf, pending, new_prefix, snapshots):
+        """Queue the renumbering of all records within the tracked prefix to new_prefix (blocking)"""
+        plans = {}
+        for zone_id in self.zone_ids:
+            # A temporary snapshot is used if snapshots are disabled
+            snapshot = snapshots.get(zone_id) or ZoneSnapshot(cf, zone_id, max_age=0)
+            # Re-list the zone: Records changed since the last listing would otherwise be missed
+            snapshot.invalidate()
+            snapshot.ensure_fresh()
+            plans[zone_id] = plan_ipv6_renumbering(list(snapshot.by_id.values()), self.prefix, new_prefix)
+        for zone_id, plan in plans.items():
+            logger.info("Renumbering IPv6 DNS records", zone_id=zone_id, records=len(plan))
+            for record, content in plan:
+                pending.patch(zone_id, record, {"content": content}, log_message="Renumbered IPv6 DNS record")
+
+    def complete(self, new_prefix):
+        """Track new_prefix after the changes queued by queue() have been submitted successfully"""
+        logger.info("IPv6 prefix renumbering complete", old=str(self.prefix), new=str(new_prefix))
+        self.prefix = new_prefix
+
+async def in_thread(semaphore, func, *args, **kwargs):
+    """Run a blocking function (e.g. a Cloudflare API call) in a worker thread, at most semaphore-many at once"""
+    async with semaphore:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+# IP version => HTTPDiscovery used by discover_current_ip() if no discovery is given (created on first use)
+default_discovery = {}
+
+async def discover_current_ip(version, discovery=None):
+    """
+    Get the current IPv4 or IPv6 address without blocking the event loop. Returns None on error.
+    discovery optionally maps the IP version (4 or 6) to a (blocking or async) function returning the current address,
+    by default the HTTPDiscovery providers are queried.
+    """
+    discover = (discovery or {}).get(version)
+    if discover is None:
+        if version not in default_discovery:
+            default_discovery[version] = HTTPDiscovery(version)
+        discover = default_discovery[version].discover
+    try:
+        if asyncio.iscoroutinefunction(discover):
+            current_ip = await discover()
+        else:
+            current_ip = await asyncio.to_thread(discover)
+        logger.debug(f"Current IPv{version} address is", ip=current_ip)
+        return current_ip
+    except Exception as ex:
+        logger.exception(ex)
+        return None
+
+def queue_host_updates(cf, pending, host, zone_id, snapshot, current_ipv4, host_ipv6):
+    """
+    Queue the A and/or AAAA record changes for a single host.
+    host_ipv6 is the IPv6 address for this host, i.e. with --ipv6-host already applied
+    Returns False if any record could not be checked.
+    """
+    ok = True
+    # Update hostname DNS with current IPv4 record
+    if host.ipv4 and current_ipv4 is not None:
+        try:
+            queue_update(cf, pending, host.hostname, zone_id, "A", current_ipv4, snapshot=snapshot, hysteresis=host.hysteresis)
+        except Exception as ex:
+            logger.exception(ex)
+            ok = False
+    # Update hostname DNS with current IPv6 record
+    if host.ipv6 and host_ipv6 is not None:
+        try:
+            queue_update(cf, pending, host.hostname, zone_id, "AAAA", host_ipv6, snapshot=snapshot, hysteresis=host.hysteresis)
+        except Exception as ex:
+            logger.exception(ex)
+            ok = False
+    return ok
+
+async def run_update_cycle(cf, hosts, zone_ids, snapshots=None, concurrency=8, discovery=None, renumbering=None):
+    """
+    Update all given hosts. The current IPv4 and IPv6 addresses are only
+    discovered once per cycle, no matter how many hosts need them.
+    snapshots maps zone IDs to ZoneSnapshot instances. If given, records are
+    compared against the snapshot instead of being fetched for every host.
+    All changes are submitted as one batch per zone at the end of the cycle.
+    Returns the discovered (IPv4, IPv6) addresses (None if not discovered) and
+    the set of hosts whose update failed, i.e. discovery of an address family the host
+    uses or a Cloudflare request for its record or zone.
+    If renumbering (a PrefixRenumbering) is given, a change of the IPv6 prefix
+    also rewrites all AAAA records within the old prefix in the same batch.
+    If that fails, all IPv6 hosts count as failed, so the renumbering is retried soon.
+
+    IP discovery for both address families runs concurrently, as do the
+    Cloudflare requests for different hosts and zones (at most concurrency at once).
+    """
+    snapshots = snapshots or {}
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = PendingUpdates()
+    current_ipv4, current_ipv6 = await asyncio.gather(
+        discover_current_ip(4, discovery) if any(host.ipv4 for host in hosts) else asyncio.sleep(0),
+        discover_current_ip(6, discovery) if any(host.ipv6 for host in hosts) else asyncio.sleep(0),
+    )
+    failed_hosts = {host for host in hosts if (host.ipv4 and current_ipv4 is None) or (host.ipv6 and current_ipv6 is None)}
+    if current_ipv4 is None and current_ipv6 is None:
+        return current_ipv4, current_ipv6, failed_hosts
+    def fail_zone(zone_id):
+        failed_hosts.update(host for host in hosts if zone_ids[host.domain] == zone_id)
+    ipv6_hosts = [host for host in hosts if host.ipv6]
+    # Refresh stale zone snapshots concurrently (and before any host needs them)
+    zone_ids_in_use = {zone_ids[host.domain] for host in hosts}
+    stale_snapshots = [snapshot for zone_id, snapshot in snapshots.items() if zone_id in zone_ids_in_use and snapshot.is_stale()]
+    results = await asyncio.gather(*(in_thread(semaphore, snapshot.ensure_fresh) for snapshot in stale_snapshots), return_exceptions=True)
+    for snapshot, result in zip(stale_snapshots, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to list zone records", zone_id=snapshot.zone_id, exception=str(result))
+            fail_zone(snapshot.zone_id)
+    # Replace host parts where enabled. The discovered address is only parsed once for all hosts
+    derived_ipv6 = {}
+    if current_ipv6 is not None:
+        templates = {host.ipv6_template for host in hosts if host.ipv6 and host.ipv6_template is not None}
+        try:
+            derived_ipv6 = IPv6HostTemplate.apply_all(templates, current_ipv6)
+        except ValueError as ex:
+            logger.error("Invalid IPv6 address", ip=current_ipv6, exception=str(ex))
+            current_ipv6 = None
+            failed_hosts.update(ipv6_hosts)
+    # Renumber whole zones if the prefix changed. Host updates queued below take precedence
+    new_prefix = None
+    if renumbering is not None and current_ipv6 is not None:
+        new_prefix = renumbering.check(current_ipv6)
+        if new_prefix is not None:
+            try:
+                await in_thread(semaphore, renumbering.queue, cf, pending, new_prefix, snapshots)
+            except Exception as ex:
+                logger.exception(ex)
+                failed_hosts.update(ipv6_hosts)
+                new_prefix = None
+    # Compare records (this only does requests for zones without snapshot)
+    results = await asyncio.gather(*(
+        in_thread(semaphore, queue_host_updates, cf, pending, host, zone_ids[host.domain], snapshots.get(zone_ids[host.domain]),
+                  current_ipv4, derived_ipv6.get(host.ipv6_template, current_ipv6))
+        for host in hosts
+    ))
+    failed_hosts.update(host for host, ok in zip(hosts, results) if not ok)
+    # Submit changes, one batch per zone
+    submitted_zone_ids = list(pending.changes)
+    results = await asyncio.gather(*(
+        in_thread(semaphore, pending.submit_zone, cf, zone_id, snapshots.get(zone_id))
+        for zone_id in submitted_zone_ids
+    ), return_exceptions=True)
+    for zone_id, result in zip(submitted_zone_ids, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to update zone records", zone_id=zone_id, exception=str(result))
+        if result:
+            fail_zone(zone_id)
+    # Only track the new prefix once every renumbered zone has been updated, otherwise renumber again next cycle
+    if new_prefix is not None:
+        zone_results = dict(zip(submitted_zone_ids, results))
+        if any(zone_results.get(zone_id, 0) for zone_id in renumbering.zone_ids):
+            failed_hosts.update(ipv6_hosts)
+        else:
+            renumbering.complete(new_prefix)
+    return current_ipv4, current_ipv6, failed_hosts
+
+# Seconds to wait for further notifications after a network change (e.g. new address + new route)
+WATCH_SETTLE_TIME = 0.5
+# After a failed update, retry after 5s, 10s, 20s, ... (jittered), but at least every host.interval
+RETRY_BASE_DELAY = 5
+
+class Scheduler:
+    """
+    Keeps the hosts in a min-heap ordered by their next update time.
+    Deadlines are based on time.monotonic() and advance by exactly host.current_interval,
+    so the time an update takes doesn't add up over time.
+    splay: The first update of every host is delayed by a random time between 0 and splay seconds
+    jitter: Every update is delayed by a random time between 0 and jitter seconds,
+            without shifting the following deadlines.
+    """
+    def __init__(self, hosts, splay=0, jitter=0):
+        self.jitter = jitter
+        self.heap = [] # (time to update, sequence number, host)
+        self.sequence = itertools.count() # Tie breaker, hosts aren't comparable
+        now = time.monotonic()
+        for host in hosts:
+            self.schedule(host, now + random.uniform(0, splay))
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, host, deadline):
+        host.next_update = deadline
+        heapq.heappush(self.heap, (deadline + random.uniform(0, self.jitter), next(self.sequence), host))
+
+    def pop_due(self, now=None):
+        """Remove and return all hosts which are due"""
+        now = time.monotonic() if now is None else now
+        due_hosts = []
+        while self.heap and self.heap[0][0] <= now:
+            due_hosts.append(heapq.heappop(self.heap)[2])
+        return due_hosts
+
+    def time_until_next(self):
+        return max(0, self.heap[0][0] - time.monotonic()) if self.heap else None
+
+    def reschedule(self, host, retry_delay=None):
+        """
+        Schedule the next update of a host that has just been updated.
+        Missed deadlines (e.g. after suspend) are skipped. Hosts with interval 0 are dropped.
+        If retry_delay is given, the host is retried after that time instead (at most host.current_interval).
+        """
+        interval = host.current_interval
+        if interval == 0:
+            return
+        now = time.monotonic()
+        if retry_delay is not None:
+            self.schedule(host, now + min(interval, retry_delay))
+            return
+        deadline = host.next_update
+        if deadline <= now:
+            deadline += (int((now - deadline) // interval) + 1) * interval
+        self.schedule(host, deadline)
+
+    def wake_up(self):
+        """Make all hosts due immediately. Their regular deadlines are kept"""
+        self.heap = [(0, sequence, host) for _, sequence, host in self.heap]
+        heapq.heapify(self.heap)
+
+async def update_loop(cf, hosts, zone_ids, snapshots, concurrency=8, discovery=None, watch=False, interface=None, state=None, renumbering=None, splay=0, jitter=0,
+                      threads=None, consensus=None):
+    """
+    Update every host every host.interval seconds. Hosts with interval 0 are only updated once.
+    See Scheduler for splay and jitter.
+    If watch is True, all hosts are also updated right after the kernel reports an address or default route change.
+    SIGUSR1 also triggers an immediate update of all hosts, SIGUSR2 logs the transport_metrics.
+    If state (a StateFile) is given, it is updated after every cycle, including the
+    unconfirmed address changes of consensus (IP version => ConsensusDiscovery) and the hosts' Hysteresis.
+    Hosts whose update failed are retried with exponential backoff before their interval has passed.
+    threads: Size of the thread pool for blocking calls (Cloudflare API, HTTP discovery).
+    Default: asyncio's default executor
+    """
+    loop = asyncio.get_running_loop()
+    if threads:
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="flaredns"))
+    scheduler = Scheduler(hosts, splay=splay, jitter=jitter)
+    network_changed = asyncio.Event()
+    watcher = NetlinkWatcher(network_changed, interface=interface).start(loop) if watch else None
+    def on_sigusr1():
+        logger.info("Received SIGUSR1")
+        network_changed.set()
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, on_sigusr1)
+        loop.add_signal_handler(signal.SIGUSR2, transport_metrics.log)
+    try:
+        while True:
+            due_hosts = scheduler.pop_due()
+            if due_hosts:
+                current_ipv4, current_ipv6, failed_hosts = await run_update_cycle(cf, due_hosts, zone_ids, snapshots, concurrency=concurrency, discovery=discovery, renumbering=renumbering)
+                if state is not None:
+                    try:
+                        state.update(zone_ids, snapshots, {4: current_ipv4, 6: current_ipv6},
+                                     renumber_prefix=renumbering.prefix if renumbering is not None else None,
+                                     candidates={version: c.state() for version, c in consensus.items()} if consensus else None,
+                                     hysteresis={host.hostname: host.hysteresis.state() for host in hosts})
+                    except OSError as ex:
+                        logger.error("Failed to save state file", filename=state.filename, exception=str(ex))
+                for host in due_hosts:
+                    failed = host in failed_hosts
+                    retry_delay = None
+                    if failed:
+                        retry_delay = host.backoff.next_delay()
+                        if host.interval:
+                            logger.info("Update failed, retrying", hostname=host.hostname, retry_in=round(retry_delay, 1))
+                    else:
+                        host.backoff.reset()
+                    host.adapt_interval(current_ipv4, current_ipv6, failed)
+                    # Retry when a change postponed by hysteresis may be published
+                    hysteresis_delay = host.hysteresis.pop_retry_delay()
+                    delays = [delay for delay in (retry_delay, hysteresis_delay) if delay is not None]
+                    scheduler.reschedule(host, min(delays) if delays else None)
+            # Check for "only update once" option
+            if not scheduler:
+                logger.debug("--interval is set to 0 => exiting")
+                break
+            sleep_time = scheduler.time_until_next()
+            logger.debug("Sleeping for", interval=sleep_time)
+            try:
+                await asyncio.wait_for(network_changed.wait(), timeout=sleep_time)
+            except asyncio.TimeoutError:
+                continue
+            # Network changed (or SIGUSR1) => Wait for related notifications to settle, then update everything
+            await asyncio.sleep(WATCH_SETTLE_TIME)
+            network_changed.clear()
+            logger.info("Network change detected, updating all hosts")
+            scheduler.wake_up()
+    finally:
+        if watcher is not None:
+            watcher.close(loop)
+        if hasattr(signal, "SIGUSR1"):
+            loop.remove_signal_handler(signal.SIGUSR1)
+            loop.remove_signal_handler(signal.SIGUSR2)
 
 DEFAULT_TIMEOUT = 5 # seconds
+DEFAULT_CONNECT_TIMEOUT = 2.5 # seconds, so the request doesn't stall during reconnect events
+CONNECT_RETRIES = 2
+
+def connect_retries(retries=CONNECT_RETRIES):
+    """
+    urllib3 Retry for HTTPAdapter(max_retries=...) which only retries failed connection attempts.
+    The request hasn't been sent at that point, so this is safe for all methods
+    """
+    return Retry(total=None, connect=retries, read=False, status=0, other=0, backoff_factor=0.1)
+
+def make_session(adapter):
+    """requests.Session using the given adapter for all HTTP and HTTPS requests"""
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+class RequestTiming:
+    """
+    Phase timings (in seconds) of a single HTTP request: dns (name resolution), connect (TCP handshake,
+    including failed attempts to other addresses), tls (TLS handshake), ttfb (request sent => response headers received)
+    and total. Phases which didn't happen, e.g. dns/connect/tls on a reused keep-alive connection, are None.
+    """
+    PHASES = ("dns", "connect", "tls", "ttfb", "total")
+
+    def __init__(self, method, url):
+        self.method = method
+        self.host = urllib.parse.urlsplit(url).netloc
+        self.dns = self.connect = self.tls = self.ttfb = self.total = None
+        self.connections = 0 # New connections, including failed ones
+        self.failed_connects = [] # Addresses which could not be connected to
+        self.status = None
+        self.error = None
+        self.start = time.monotonic()
+
+    def add(self, phase, seconds):
+        # Phases can happen multiple times if the connection is retried
+        setattr(self, phase, (getattr(self, phase) or 0) + seconds)
+
+    @property
+    def retries(self):
+        return max(0, self.connections - 1)
+
+    def finish(self):
+        self.total = time.monotonic() - self.start
+
+    def fields(self):
+        """Log fields, phases in milliseconds"""
+        fields = {"host": self.host, "method": self.method, "status": self.status, "retries": self.retries}
+        for phase in self.PHASES:
+            if getattr(self, phase) is not None:
+                fields[f"{phase}_ms"] = round(getattr(self, phase) * 1000, 1)
+        if self.failed_connects:
+            fields["failed_connects"] = self.failed_connects
+        if self.error:
+            fields["error"] = self.error
+        return fields
+
+class TransportMetrics:
+    """
+    Thread-safe aggregate of the RequestTimings of all requests, per upstream host.
+    snapshot() returns {host: {"requests", "errors", "retries", "new_connections", "failed_connects",
+    "status": {status: count}, <phase>: {"count", "mean", "max"} (in seconds)}}
+    """
+    def __init__(self):
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def record(self, timing):
+        with self.lock:
+            stats = self.hosts.get(timing.host)
+            if stats is None:
+                stats = self.hosts[timing.host] = {
+                    "requests": 0, "errors": 0, "retries": 0, "new_connections": 0, "failed_connects": 0,
+                    "status": collections.Counter(), "phases": {phase: [0, 0.0, 0.0] for phase in RequestTiming.PHASES}
+                }
+            stats["requests"] += 1
+            stats["errors"] += timing.error is not None
+            stats["retries"] += timing.retries
+            stats["new_connections"] += timing.connections
+            stats["failed_connects"] += len(timing.failed_connects)
+            if timing.status is not None:
+                stats["status"][timing.status] += 1
+            for phase, values in stats["phases"].items():
+                seconds = getattr(timing, phase)
+                if seconds is not None:
+                    values[0] += 1
+                    values[1] += seconds
+                    values[2] = max(values[2], seconds)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for host, stats in self.hosts.items():
+                snapshot[host] = {key: value for key, value in stats.items() if key not in ("status", "phases")}
+                snapshot[host]["status"] = dict(stats["status"])
+                for phase, (count, total, maximum) in stats["phases"].items():
+                    if count:
+                        snapshot[host][phase] = {"count": count, "mean": total / count, "max": maximum}
+            return snapshot
+
+    def log(self):
+        for host, stats in self.snapshot().items():
+            phases = {f"{phase}_ms": {"mean": round(stats[phase]["mean"] * 1000, 1), "max": round(stats[phase]["max"] * 1000, 1)}
+                      for phase in RequestTiming.PHASES if phase in stats}
+            logger.info("Transport metrics", host=host, requests=stats["requests"], errors=stats["errors"], retries=stats["retries"],
+                        new_connections=stats["new_connections"], failed_connects=stats["failed_connects"], status=stats["status"], **phases)
+
+# Used by all TimeoutHTTPAdapters unless they are given their own
+transport_metrics = TransportMetrics()
+
+# The RequestTiming of the request currently sent by this thread (see TimeoutHTTPAdapter.send)
+_transport_local = threading.local()
+
+def current_request_timing():
+    return getattr(_transport_local, "timing", None)
+
+class InstrumentedHTTPConnection(HTTPConnection):
+    """urllib3 HTTPConnection recording DNS, connect and TTFB timings into the current RequestTiming"""
+    def _new_conn(self):
+        # Same as urllib3's create_connection(), but with timings and a record of every failed address
+        timing = current_request_timing() or RequestTiming(None, "")
+        timing.connections += 1
+        start = time.monotonic()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host.strip("[]"), self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except socket.gaierror as ex:
+            raise NameResolutionError(self.host, self, ex) from ex
+        finally:
+            timing.add("dns", time.monotonic() - start)
+        start = time.monotonic()
+        error = None
+        try:
+            for family, socktype, proto, _, address in addresses:
+                attempt_start = time.monotonic()
+                sock = socket.socket(family, socktype, proto)
+                try:
+                    for option in self.socket_options or []:
+                        sock.setsockopt(*option)
+                    if self.timeout is None or isinstance(self.timeout, (int, float)): # Not urllib3's "default timeout" sentinel
+                        sock.settimeout(self.timeout)
+                    if self.source_address:
+                        sock.bind(self.source_address)
+                    sock.connect(address)
+                    return sock
+                except OSError as ex:
+                    sock.close()
+                    error = ex
+                    timing.failed_connects.append(address[0])
+                    logger.debug("Connection attempt failed", host=f"{self.host}:{self.port}", address=address[0], exception=str(ex) or type(ex).__name__,
+                                 elapsed_ms=round((time.monotonic() - attempt_start) * 1000, 1))
+        finally:
+            timing.add("connect", time.monotonic() - start)
+            self._connected_at = time.monotonic()
+        if isinstance(error, socket.timeout):
+            raise ConnectTimeoutError(self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})") from error
+        raise NewConnectionError(self, f"Failed to establish a new connection: {error or 'getaddrinfo returned no addresses'}") from error
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        self._request_sent_at = time.monotonic()
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        timing = current_request_timing()
+        if timing is not None:
+            timing.add("ttfb", time.monotonic() - self._request_sent_at)
+        return response
+
+class InstrumentedHTTPSConnection(InstrumentedHTTPConnection, HTTPSConnection):
+    """InstrumentedHTTPConnection which also records the TLS handshake time"""
+    def connect(self):
+        super().connect()
+        timing = current_request_timing()
+        if timing is not None:
+            timing.add("tls", time.monotonic() - self._connected_at)
+
+class InstrumentedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = InstrumentedHTTPConnection
+
+class InstrumentedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = InstrumentedHTTPSConnection
 
 class TimeoutHTTPAdapter(HTTPAdapter):
-    """Original source: https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks/"""
+    """
+    Original source: https://findwork.dev/blog/advanced-usage-python-requests-timeouts-retries-hooks/
+    Additionally records the phase timings of every request (see RequestTiming) into metrics
+    (default: transport_metrics) and logs them.
+    """
     def __init__(self, *args, **kwargs):
         self.timeout = DEFAULT_TIMEOUT
         if "timeout" in kwargs:
             self.timeout = kwargs["timeout"]
             del kwargs["timeout"]
+        self.metrics = kwargs.pop("metrics", transport_metrics)
         super().__init__(*args, **kwargs)
 
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": InstrumentedHTTPConnectionPool, "https": InstrumentedHTTPSConnectionPool}
+
     def send(self, request, **kwargs):
         timeout = kwargs.get("timeout")
         if timeout is None:
             kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
+        timing = _transport_local.timing = RequestTiming(request.method, request.url)
+        try:
+            response = super().send(request, **kwargs)
+            timing.status = response.status_code
+            return response
+        except Exception as ex:
+            timing.error = type(ex).__name__
+            raise
+        finally:
+            _transport_local.timing = None
+            timing.finish()
+            self.metrics.record(timing)
+            logger.debug("HTTP request", **timing.fields())
+
+PRIORITY_HIGH = 0 # Record changes
+PRIORITY_LOW = 1 # Reads, e.g. zone reconciliation
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: Holds up to capacity tokens and is refilled with rate tokens per second.
+    Every request takes one token and blocks until one is available.
+    Low priority requests leave the last reserve tokens to high priority requests and
+    always wait while high priority requests are waiting.
+    """
+    def __init__(self, rate, capacity, reserve=0):
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = min(reserve, capacity - 1)
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.high_priority_waiting = 0
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _wait_time(self, priority, now):
+        """How long to wait until a token can be taken (0 => take it now)"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        needed = 1 if priority == PRIORITY_HIGH else 1 + self.reserve
+        if priority != PRIORITY_HIGH and self.high_priority_waiting:
+            return 1 / self.rate
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def _take(self, priority):
+        """Take a token if possible. Returns how long to wait before trying again (0 => token taken)"""
+        now = time.monotonic()
+        self._refill(now)
+        wait_time = self._wait_time(priority, now)
+        if wait_time <= 0:
+            self.tokens -= 1
+        return wait_time
+
+    def acquire(self, priority=PRIORITY_HIGH):
+        with self.condition:
+            if priority == PRIORITY_HIGH:
+                self.high_priority_waiting += 1
+            try:
+                while True:
+                    wait_time = self._take(priority)
+                    if wait_time <= 0:
+                        return
+                    self.condition.wait(wait_time)
+            finally:
+                if priority == PRIORITY_HIGH:
+                    self.high_priority_waiting -= 1
+                    self.condition.notify_all()
+
+    def pause(self, seconds):
+        """Don't hand out any tokens for the given time, e.g. after a 429 response"""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket whose state is kept in a file, so all processes using the same file
+    (e.g. multiple FlareDNS instances for the same Cloudflare account) share one budget.
+    Every access locks the file using flock(), so this only works on local filesystems.
+    A pause (after a 429 response) also applies to all processes.
+    """
+    def __init__(self, filename, rate, capacity, reserve=0):
+        import fcntl # Unix only
+        self.fcntl = fcntl
+        self.filename = filename
+        super().__init__(rate, capacity, reserve)
+
+    def _locked(self, func):
+        """Call func() with the state loaded from the file and the file locked, then write back the state"""
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+") as fileobj:
+            self.fcntl.flock(fileobj, self.fcntl.LOCK_EX)
+            try:
+                state = json.loads(fileobj.read() or "{}")
+            except ValueError:
+                state = {}
+            now = time.time()
+            # Wall-clock time since the file outlives processes (and reboots)
+            self.tokens = state.get("tokens", self.capacity)
+            self.updated_at = min(state.get("updated_at", now), now)
+            self.paused_until = state.get("paused_until", 0)
+            result = func(now)
+            fileobj.seek(0)
+            fileobj.truncate()
+            json.dump({"tokens": self.tokens, "updated_at": self.updated_at, "paused_until": self.paused_until}, fileobj)
+            fileobj.flush()
+            return result
+
+    def _take(self, priority):
+        def take(now):
+            self._refill(now)
+            wait_time = self._wait_time(priority, now)
+            if wait_time <= 0:
+                self.tokens -= 1
+            return wait_time
+        return self._locked(take)
+
+    def pause(self, seconds):
+        def pause(now):
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+        with self.condition:
+            self._locked(pause)
+
+def make_rate_limit_bucket(limit, window, burst, filename=None):
+    """
+    Create a token bucket allowing at most limit requests per window seconds, at most burst at once.
+    If filename is given, the budget is shared with all processes using the same file.
+    """
+    # Burst + refill within one window must not exceed the limit
+    burst = min(burst, limit)
+    rate = max(limit - burst, 1) / window
+    if filename:
+        return SharedTokenBucket(filename, rate, burst, reserve=burst // 5)
+    return TokenBucket(rate, burst, reserve=burst // 5)
+
+def parse_retry_after(value, default=60):
+    """Parse a Retry-After header (seconds or HTTP date) into seconds"""
+    if not value:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+class RateLimitedHTTPAdapter(TimeoutHTTPAdapter):
+    """
+    TimeoutHTTPAdapter that takes a token from a TokenBucket for every request (unless bucket is None).
+    Writes have priority over reads. On a 429 response, all requests are paused
+    for the duration given by the Retry-After header and the request is retried.
+    """
+    def __init__(self, *args, bucket=None, max_retries_429=3, **kwargs):
+        self.bucket = bucket
+        self.max_retries_429 = max_retries_429
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        priority = PRIORITY_LOW if request.method in ("GET", "HEAD") else PRIORITY_HIGH
+        for attempt in range(self.max_retries_429 + 1):
+            if self.bucket is not None:
+                self.bucket.acquire(priority)
+            response = super().send(request, **kwargs)
+            if response.status_code != 429 or self.bucket is None or attempt == self.max_retries_429:
+                return response
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            logger.warning("Cloudflare API rate limit exceeded, pausing requests", retry_after=retry_after, url=request.url)
+            self.bucket.pause(retry_after)
+            response.close()
+        return response
+
+class CircuitBreakerHTTPAdapter(RateLimitedHTTPAdapter):
+    """
+    RateLimitedHTTPAdapter with one circuit breaker per host.
+    Connection errors, timeouts and 5xx responses count as failures. While a breaker is open,
+    requests fail immediately with CircuitOpenError instead of being sent (or waiting for a rate limit token).
+    """
+    def __init__(self, *args, breakers=None, **kwargs):
+        self.breakers = breakers or CircuitBreakers()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        breaker = self.breakers[urllib.parse.urlsplit(request.url).netloc]
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit breaker for {breaker.name} is open", request=request)
+        try:
+            response = super().send(request, **kwargs)
+        except BaseException:
+            # Any exception, e.g. from the rate limit file, so a half-open trial always has an outcome
+            breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+# Connection-specific headers, not allowed in HTTP/2
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade"}
+
+class HTTPXAdapter(HTTPAdapter):
+    """
+    Transport adapter sending requests through an httpx client with HTTP/2 support,
+    so concurrent requests to the same host are multiplexed over a single connection.
+    Plain http:// URLs and servers without HTTP/2 support use HTTP/1.1.
+    Responses are always read completely (stream=True is ignored).
+    """
+    def __init__(self, *args, pool_maxsize=10, **kwargs):
+        if httpx is None:
+            raise ImportError("HTTP/2 requires httpx and h2: pip install httpx[http2]")
+        super().__init__(*args, pool_maxsize=pool_maxsize, **kwargs)
+        self.client = httpx.Client(transport=httpx.HTTPTransport(
+            http2=True, retries=self.max_retries.connect or 0,
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)))
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        headers = {key: value for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+        try:
+            upstream = self.client.send(self.client.build_request(
+                request.method, request.url, headers=headers, content=request.body,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                extensions={"trace": self._trace_callback(current_request_timing())}))
+        except httpx.ConnectTimeout as ex:
+            raise requests.exceptions.ConnectTimeout(ex, request=request)
+        except httpx.TimeoutException as ex:
+            raise requests.exceptions.ReadTimeout(ex, request=request)
+        except httpx.TransportError as ex:
+            raise requests.exceptions.ConnectionError(ex, request=request)
+        response = requests.Response()
+        response.status_code = upstream.status_code
+        response.reason = upstream.reason_phrase
+        response.headers = requests.structures.CaseInsensitiveDict(upstream.headers.items())
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = upstream.content # Already decompressed by httpx
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    # httpcore trace events => RequestTiming phases. httpcore doesn't report name resolution separately, it's part of connect
+    TRACE_PHASES = {"connection.connect_tcp": "connect", "connection.start_tls": "tls",
+                    "http11.receive_response_headers": "ttfb", "http2.receive_response_headers": "ttfb"}
+
+    def _trace_callback(self, timing):
+        started = {}
+        def trace(event, info):
+            name, _, stage = event.rpartition(".")
+            if name not in self.TRACE_PHASES or timing is None:
+                return
+            if stage == "started":
+                started[name] = time.monotonic()
+                if name == "connection.connect_tcp":
+                    timing.connections += 1
+            elif name in started:
+                timing.add(self.TRACE_PHASES[name], time.monotonic() - started.pop(name))
+                if stage == "failed" and name == "connection.connect_tcp":
+                    timing.failed_connects.append(timing.host) # httpcore doesn't report the address
+        return trace
+
+    def close(self):
+        self.client.close()
+        super().close()
+
+class HTTP2CircuitBreakerHTTPAdapter(CircuitBreakerHTTPAdapter, HTTPXAdapter):
+    """CircuitBreakerHTTPAdapter sending requests via HTTP/2 (see HTTPXAdapter)"""
+
+def make_cloudflare_session(timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_TIMEOUT), pool_size=10, bucket=None, http2=False):
+    """
+    requests.Session for the Cloudflare API with a keep-alive connection pool of pool_size connections,
+    connect retries, rate limiting and circuit breakers. Uses HTTP/2 if requested and available
+    """
+    kwargs = dict(timeout=timeout, pool_maxsize=pool_size, max_retries=connect_retries(), bucket=bucket)
+    if http2:
+        try:
+            return make_session(HTTP2CircuitBreakerHTTPAdapter(**kwargs))
+        except ImportError as ex:
+            logger.warning("HTTP/2 is not available, using HTTP/1.1", exception=str(ex))
+    return make_session(CircuitBreakerHTTPAdapter(**kwargs))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-e", "--email", required=True, help="The Cloudflare login email to use")
-    parser.add_argument("-k", "--api-key", required=True, help="The Cloudflare global API key to use. NOTE: Domain-specific API tokens will NOT work!")
-    parser.add_argument("-n", "--hostname", required=True, help="The hostname to update, e.g. mydyndns.mydomain.com")
+    parser.add_argument("-c", "--config", default=None, help="YAML, TOML or JSON config file listing multiple hostnames to update from a single process. See examples/flaredns.yaml")
+    parser.add_argument("-e", "--email", default=None, help="The Cloudflare login email to use")
+    parser.add_argument("-k", "--api-key", default=None, help="The Cloudflare global API key to use. NOTE: Domain-specific API tokens will NOT work!")
+    parser.add_argument("-n", "--hostname", default=None, help="The hostname to update, e.g. mydyndns.mydomain.com")
     parser.add_argument("-4", "--ipv4", action="store_true", help="Update A record with the current IPv4")
     parser.add_argument("-6", "--ipv6", action="store_true", help="Update AAAA record with the current IPv6")
     parser.add_argument("-s", "--ipv6-host", default=None,
                         help="""If given, replace the IPv6 host part of the address - typically used when updating for another device such as in dynamic DNS situations.\n
 Specify as address with length, defining how many bits to replace such as ::dead:cafe/64""")
+    parser.add_argument("--ipv4-url", action="append", default=None, help=f"A URL to request the current IPv4 address from. Can be given multiple times, all URLs are queried concurrently and the first valid answer is used. Default: {', '.join(IPV4_URLS)}")
+    parser.add_argument("--ipv6-url", action="append", default=None, help=f"A URL to request the current IPv6 address from. Can be given multiple times, all URLs are queried concurrently and the first valid answer is used. Default: {', '.join(IPV6_URLS)}")
+    parser.add_argument("--ipv4-source", action="append", choices=["http", "local", "stun", "dns", "natpmp", "pcp", "upnp"], default=None, help="How to find the current IPv4 address: http (ask --ipv4-url), local (address assigned to a local interface), stun (ask --stun-server), dns (--ipv4-dns-query) or ask the router via natpmp, pcp or upnp. Can be given multiple times, see --quorum. Default: http")
+    parser.add_argument("--ipv6-source", action="append", choices=["http", "local", "stun", "dns"], default=None, help="How to find the current IPv6 address: http (ask --ipv6-url), local (address assigned to a local interface), stun (ask --stun-server) or dns (--ipv6-dns-query). Can be given multiple times, see --quorum. Default: http")
+    parser.add_argument("--quorum", type=int, default=None, help="Only use an address if at least this many of the --ipv4-source / --ipv6-source sources report it. Default: 1")
+    parser.add_argument("--confirmations", type=int, default=None, help="Only publish a changed address after it has been discovered in this many consecutive update cycles. Default: 1")
+    parser.add_argument("--allow-private", action="store_true", help="Accept private, reserved and CGNAT addresses (e.g. 10.0.0.0/8, 100.64.0.0/10) as current address. By default they are ignored")
+    parser.add_argument("--stun-server", action="append", default=None, help=f"A STUN server (host:port) for --ipv4-source stun / --ipv6-source stun. Can be given multiple times, all servers are queried concurrently. Default: {', '.join(STUN_SERVERS)}")
+    parser.add_argument("--ipv4-dns-query", action="append", default=None, help=f"A DNS query (in dig syntax) answered with our IPv4 address for --ipv4-source dns. Can be given multiple times, all queries run concurrently. Default: {', '.join(DNS_QUERIES_V4)}")
+    parser.add_argument("--ipv6-dns-query", action="append", default=None, help=f"A DNS query (in dig syntax) answered with our IPv6 address for --ipv6-source dns. Can be given multiple times, all queries run concurrently. Default: {', '.join(DNS_QUERIES_V6)}")
+    parser.add_argument("--gateway", default=None, help="The router for --ipv4-source natpmp/pcp (host or host:port) or the device description URL for --ipv4-source upnp. Default: The default gateway / found via SSDP")
+    parser.add_argument("--interface", default=None, help="Only consider addresses of this interface for --ipv4-source local / --ipv6-source local, e.g. eth0")
+    parser.add_argument("-w", "--watch", action="store_true", help="Additionally update immediately when the kernel reports an address or default route change (Linux only). --interval then only acts as a safety net and can be increased")
+    parser.add_argument("--state-file", default=None, help="File to persist zone IDs, records and the last discovered IPs in, so restarts and one-shot runs don't need to fetch them again")
+    parser.add_argument("--renumber-prefix-length", type=int, default=None, help="Track the delegated IPv6 prefix of this length (e.g. 48, 56 or 64). When it changes, rewrite all AAAA records within the old prefix to the new prefix, keeping their host part")
+    parser.add_argument("--renumber-zone", action="append", default=None, help="Zone to renumber with --renumber-prefix-length, e.g. mydomain.com. Can be given multiple times. Default: The zones of all hosts with --ipv6")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Maximum number of Cloudflare API requests per --rate-limit-window. Set to 0 to disable client-side rate limiting. Default: 1200 (Cloudflare's limit)")
+    parser.add_argument("--rate-limit-window", type=float, default=None, help="Rate limit window in seconds. Default: 300")
+    parser.add_argument("--rate-limit-burst", type=int, default=None, help="Maximum number of Cloudflare API requests in a burst. Default: 100")
+    parser.add_argument("--rate-limit-file", default=None, help="Share the rate limit budget with other processes (FlareDNS or examples/CopyDNS.py) using the same file. Use one file per Cloudflare account, e.g. /run/flaredns/ratelimit-myaccount.json")
+    parser.add_argument("--cloudflare-url", default=None, help="Cloudflare API base URL, e.g. for testing with examples/MockCloudflare.py. Default: https://api.cloudflare.com/client/v4")
+    parser.add_argument("--connect-timeout", type=float, default=None, help=f"Timeout in seconds for connecting to the Cloudflare API and HTTP discovery providers. Default: {DEFAULT_CONNECT_TIMEOUT}")
+    parser.add_argument("--read-timeout", type=float, default=None, help=f"Timeout in seconds for responses of the Cloudflare API and HTTP discovery providers, and for STUN, DNS and router queries. Default: {DEFAULT_TIMEOUT}")
+    parser.add_argument("--pool-size", type=int, default=None, help="Maximum number of kept-alive connections to the Cloudflare API. Default: --concurrency, at least 10")
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2 for the Cloudflare API, multiplexing concurrent requests over a single connection. Requires httpx and h2 (pip install httpx[http2])")
     parser.add_argument("-d", "--debug", action="store_true", help="Additional debug logging")
-    parser.add_argument("-i", "--interval", type=int, default=60, help="The update interval in seconds. Set to 0 to only update once. Strictly speaking the sleep time after any update attempt")
+    parser.add_argument("-i", "--interval", type=int, default=None, help="The update interval in seconds. Set to 0 to only update once. Updates start every interval seconds, no matter how long an update takes. Default: 60")
+    parser.add_argument("--max-interval", type=int, default=None, help="Enable adaptive update intervals: While the IP address doesn't change, the interval doubles after every update up to this many seconds. After an address change or error, it falls back to --interval. Default: disabled")
+    parser.add_argument("--min-dwell", type=float, default=None, help="Only publish a new address once it has been discovered for this many seconds. Address changes that are reverted within that time (A => B => A) cause no update. Default: 0")
+    parser.add_argument("--max-updates", type=int, default=None, help="Change the records of a host at most this many times per --max-updates-window. Further changes are postponed. Default: 0 (unlimited)")
+    parser.add_argument("--max-updates-window", type=float, default=None, help="The window for --max-updates in seconds. Default: 3600")
+    parser.add_argument("--splay", type=float, default=None, help="Delay the first update of every host by a random time of up to this many seconds, so instances started at the same time don't update in lockstep. Default: 0")
+    parser.add_argument("--jitter", type=float, default=None, help="Delay every update by a random time of up to this many seconds (without shifting the following updates). Default: 0")
+    parser.add_argument("-j", "--concurrency", type=int, default=None, help="Maximum number of concurrent Cloudflare API requests. Default: 8")
+    parser.add_argument("-r", "--reconcile-interval", type=int, default=None, help="How often (in seconds) to re-list all records of a zone. In between, records are compared against an in-memory copy of the zone. Set to 0 to fetch records on every update. Default: 3600")
     args = parser.parse_args()
 
-    if args.debug:
+    config = load_config(args.config) if args.config else {}
+
+    if args.debug or config.get("debug", False):
         logging.getLogger().setLevel(logging.DEBUG)
     else:
         logging.getLogger().setLevel(logging.INFO)
 
-    if not args.ipv4 and not args.ipv6:
-        logger.error("Please use at least one of --ipv4 and --ipv6")
+    # Command line arguments take precedence over the config file
+    email = args.email or config.get("email")
+    api_key = args.api_key or config.get("api_key")
+    interval = args.interval if args.interval is not None else config.get("interval", 60)
+    max_interval = args.max_interval if args.max_interval is not None else config.get("max_interval")
+    min_dwell = args.min_dwell if args.min_dwell is not None else config.get("min_dwell", 0)
+    max_updates = args.max_updates if args.max_updates is not None else config.get("max_updates", 0)
+    max_updates_window = args.max_updates_window or config.get("max_updates_window", 3600)
+    splay = args.splay if args.splay is not None else config.get("splay", 0)
+    jitter = args.jitter if args.jitter is not None else config.get("jitter", 0)
+    ipv4_urls = args.ipv4_url or config.get("ipv4_url", IPV4_URLS)
+    ipv6_urls = args.ipv6_url or config.get("ipv6_url", IPV6_URLS)
+    # Allow a single URL in the config file
+    ipv4_urls = [ipv4_urls] if isinstance(ipv4_urls, str) else ipv4_urls
+    ipv6_urls = [ipv6_urls] if isinstance(ipv6_urls, str) else ipv6_urls
+    stun_servers = args.stun_server or config.get("stun_server", STUN_SERVERS)
+    stun_servers = [stun_servers] if isinstance(stun_servers, str) else stun_servers
+    ipv4_dns_queries = args.ipv4_dns_query or config.get("ipv4_dns_query", DNS_QUERIES_V4)
+    ipv6_dns_queries = args.ipv6_dns_query or config.get("ipv6_dns_query", DNS_QUERIES_V6)
+    ipv4_dns_queries = [ipv4_dns_queries] if isinstance(ipv4_dns_queries, str) else ipv4_dns_queries
+    ipv6_dns_queries = [ipv6_dns_queries] if isinstance(ipv6_dns_queries, str) else ipv6_dns_queries
+    ipv4_sources = args.ipv4_source or config.get("ipv4_source", ["http"])
+    ipv6_sources = args.ipv6_source or config.get("ipv6_source", ["http"])
+    ipv4_sources = [ipv4_sources] if isinstance(ipv4_sources, str) else ipv4_sources
+    ipv6_sources = [ipv6_sources] if isinstance(ipv6_sources, str) else ipv6_sources
+    quorum = args.quorum or config.get("quorum", 1)
+    confirmations = args.confirmations or config.get("confirmations", 1)
+    allow_private = args.allow_private or config.get("allow_private", False)
+    interface = args.interface or config.get("interface")
+    gateway = args.gateway or config.get("gateway")
+    watch = args.watch or config.get("watch", False)
+    state_file = args.state_file or config.get("state_file")
+    renumber_prefix_length = args.renumber_prefix_length or config.get("renumber_prefix_length")
+    renumber_zones = args.renumber_zone or config.get("renumber_zones")
+    rate_limit = args.rate_limit if args.rate_limit is not None else config.get("rate_limit", 1200)
+    rate_limit_window = args.rate_limit_window or config.get("rate_limit_window", 300)
+    rate_limit_burst = args.rate_limit_burst or config.get("rate_limit_burst", 100)
+    rate_limit_file = args.rate_limit_file or config.get("rate_limit_file")
+    cloudflare_url = args.cloudflare_url or config.get("cloudflare_url")
+    concurrency = args.concurrency if args.concurrency is not None else config.get("concurrency", 8)
+    connect_timeout = args.connect_timeout or config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)
+    read_timeout = args.read_timeout or config.get("read_timeout", DEFAULT_TIMEOUT)
+    pool_size = args.pool_size or config.get("pool_size", max(concurrency, 10))
+    http2 = args.http2 or config.get("http2", False)
+    reconcile_interval = args.reconcile_interval if args.reconcile_interval is not None else config.get("reconcile_interval", 3600)
+    if not email or not api_key:
+        logger.error("Please specify --email and --api-key (or email and api_key in the config file)")
         sys.exit(1)
 
-    # Extract domain from hostname: "test.mydomain.com" => mydomain.com
-    domain = ".".join(args.hostname.split(".")[-2:])
+    try:
+        hosts = hosts_from_config(config, default_interval=interval, default_max_interval=max_interval)
+        if args.hostname:
+            hosts.append(Host(args.hostname, ipv4=args.ipv4, ipv6=args.ipv6, ipv6_host=args.ipv6_host, interval=interval, max_interval=max_interval))
+    except ValueError as ex:
+        logger.error(str(ex))
+        sys.exit(1)
+    if not hosts:
+        logger.error("Please specify --hostname or a --config file with at least one host")
+        sys.exit(1)
+    for host in hosts:
+        if not host.ipv4 and not host.ipv6:
+            logger.error("Please use at least one of --ipv4 and --ipv6", hostname=host.hostname)
+            sys.exit(1)
+        host.hysteresis = Hysteresis(min_dwell, max_updates, max_updates_window)
+    # One-shot runs (--interval 0) only remember unconfirmed and postponed changes in the state file
+    if (confirmations > 1 or min_dwell or max_updates) and not state_file and any(host.interval == 0 for host in hosts):
+        logger.error("--confirmations, --min-dwell and --max-updates with --interval 0 require --state-file")
+        sys.exit(1)
 
-    # Initialize Cloudflare API client
+    # IP address discovery backends
+    try:
+        consensus = {}
+        for version, sources, urls, dns_queries in ((4, ipv4_sources, ipv4_urls, ipv4_dns_queries), (6, ipv6_sources, ipv6_urls, ipv6_dns_queries)):
+            # Only for address families used by any host
+            if not any(host.ipv4 if version == 4 else host.ipv6 for host in hosts):
+                continue
+            consensus[version] = ConsensusDiscovery(version, {
+                source: make_discovery(version, source, urls=urls, interface=interface, stun_servers=stun_servers,
+                                       dns_queries=dns_queries, gateway=gateway, allow_private=allow_private,
+                                       timeout=read_timeout, http_timeout=(connect_timeout, read_timeout)).discover
+                for source in sources
+            }, quorum=quorum, confirmations=confirmations, allow_private=allow_private)
+        discovery = {version: consensus[version].discover for version in consensus}
+    except ImportError as ex:
+        logger.error("Missing dependency for the selected IP address source", exception=str(ex))
+        sys.exit(1)
+    except ValueError as ex:
+        logger.error(str(ex))
+        sys.exit(1)
+    # Initialize Cloudflare API client. All hosts share the same client & session
     cf = CloudFlare.CloudFlare(
-        email=args.email,
-        token=args.api_key
+        email=email,
+        token=api_key,
+        base_url=cloudflare_url
     )
-    # Force set timeout for Cloudflare requests (so the request doesn't stall during reconnect events)
-    cf._base.network.session = requests.Session()
-    adapter = TimeoutHTTPAdapter(timeout=2.5)
-    cf._base.network.session.mount("https://", adapter)
-    cf._base.network.session.mount("http://", adapter)
-    # Get zone ID. This is done only once and it's assumed to not chage
-    zones = cf.zones.get(params={"name": domain})
-    if len(zones) == 0:
-        logger.error("Could not find any zones for domain, please check --hostname", domain=domain, hostname=args.hostname)
-        sys.exit(2)
-    zone_id = zones[0]["id"]
-    # Update loop
+    # Replace the client's session: Timeouts (so the request doesn't stall during reconnect events), keep-alive pool, rate limit
+    bucket = None
+    if rate_limit > 0:
+        bucket = make_rate_limit_bucket(rate_limit, rate_limit_window, rate_limit_burst, filename=rate_limit_file)
+    cf._base.network.session = make_cloudflare_session(timeout=(connect_timeout, read_timeout), pool_size=pool_size, bucket=bucket, http2=http2)
+    # Load last known state
+    state = None
+    if state_file:
+        state = StateFile(state_file)
+        state.load()
+        # Address changes are confirmed against the last published addresses
+        for version in consensus:
+            consensus[version].accepted = state.last_ips.get(str(version))
+            consensus[version].restore(state.candidates.get(str(version)))
+        for host in hosts:
+            host.hysteresis.restore(state.hysteresis.get(host.hostname))
+    # Get zone IDs. Retry with backoff if Cloudflare is unreachable
+    if renumber_prefix_length and not renumber_zones:
+        renumber_zones = sorted({host.domain for host in hosts if host.ipv6})
+    backoff = Backoff(RETRY_BASE_DELAY)
     while True:
-        # Update hostname DNS with current IPv4 record
-        if args.ipv4:
-            try:
-                current_ipv4 = get_current_ipv4()
-                logger.debug("Current IPv4 address is", ip=current_ipv4)
-                if current_ipv4 is not None:
-                    check_and_perform_ipv4_update(cf, args.hostname, zone_id, current_ipv4)
-            except Exception as ex:
-                logger.exception(ex)
-        # Update hostname DNS with current IPv6 record
-        if args.ipv6:
-            try:
-                current_ipv6 = get_current_ipv6()
-                logger.debug("Current IPv6 address is", ip=current_ipv6)
-                # Replace host part if enabled
-                if args.ipv6_host is not None:
-                    host_addr_str, _, net_prefix_length_str = args.ipv6_host.partition("/")
-                    if not net_prefix_length_str or not host_addr_str:
-                        raise Exception(f"You need to specify --ipv6-host with prefix length such as ::dead:cafe/64, not {args.ipv6_host}")
-                    host_addr = ipaddress.IPv6Address(host_addr_str)
-                    original_ipv6 = ipaddress.IPv6Address(current_ipv6)
-                    current_ipv6 = str(replace_ipv6_host_part(original_ipv6, host_addr, net_prefix_length_str))
-                    logger.debug("Replacing IPv6 host part", host_addr=host_addr, net_addr=original_ipv6, prefix_size=net_prefix_length_str, result=current_ipv6)
-                if current_ipv6 is not None:
-                    check_and_perform_ipv6_update(cf, args.hostname, zone_id, current_ipv6)
-            except Exception as ex:
-                logger.exception(ex)
-        # Check for "only update once" option
-        if args.interval == 0:
-            logger.debug("--interval is set to 0 => exiting")
+        try:
+            zone_ids = lookup_zone_ids(cf, [host.domain for host in hosts] + (renumber_zones or []), known=state.zone_ids if state else None)
             break
-        logger.debug("Sleeping for", interval=args.interval)
-        time.sleep(args.interval)
-    
+        except KeyError as ex:
+            logger.error("Could not find any zones for domain, please check --hostname", domain=ex.args[0])
+            sys.exit(2)
+        except CloudFlare.exceptions.CloudFlareAPIError as ex:
+            retry_delay = backoff.next_delay()
+            logger.error("Failed to look up zones, retrying", exception=str(ex), retry_in=round(retry_delay, 1))
+            time.sleep(retry_delay)
+    # Zone snapshots to avoid listing records on every update
+    snapshots = {}
+    if reconcile_interval > 0:
+        snapshots = {zone_id: ZoneSnapshot(cf, zone_id, max_age=reconcile_interval) for zone_id in zone_ids.values()}
+        if state is not None:
+            for snapshot in snapshots.values():
+                state.restore_snapshot(snapshot)
+    renumbering = None
+    if renumber_prefix_length:
+        renumbering = PrefixRenumbering(renumber_prefix_length, [zone_ids[zone] for zone in renumber_zones],
+                                        last_ipv6=state.last_ips.get("6") if state else None,
+                                        prefix=state.renumber_prefix if state else None)
+    # Update loop. Requests to slow HTTP providers keep their thread after another provider answered,
+    # so reserve two threads per provider (this and the previous cycle) in addition to the Cloudflare API calls
+    threads = concurrency + 2 * (len(ipv4_urls) + len(ipv6_urls)) + 4
+    asyncio.run(update_loop(cf, hosts, zone_ids, snapshots, concurrency=concurrency, discovery=discovery, watch=watch, interface=interface, state=state, renumbering=renumbering,
+                            splay=splay, jitter=jitter, threads=threads, consensus=consensus))
@@ -0,0 +1,62 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import flaredns
+
+class Clock:
+    """Replaces time.monotonic() in tests, advanced explicitly"""
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(flaredns.time, "monotonic", clock)
+    return clock
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def mock_cloudflare():
+    """
+    Factory starting examples/MockCloudflare.py with the given arguments.
+    Returns the Cloudflare API base URL. The ipify, STUN and router stand-ins are disabled.
+    """
+    processes = []
+    def start(*args):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "examples", "MockCloudflare.py"), "--port", str(port),
+             "--ipify-port", "0", "--stun-port", "0", "--natpmp-port", "0", "--upnp-port", "0", *args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("MockCloudflare.py didn't start")
+                time.sleep(0.05)
+        return f"http://127.0.0.1:{port}"
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,85 @@
+"""Zone listing and record updates against examples/MockCloudflare.py"""
+import CloudFlare
+import requests
+import pytest
+import flaredns
+
+ZONE = "example.com"
+# Unknown to the mock
+OUTDATED_RECORD_ID = "0" * 32
+
+def connect(base_url):
+    cf = CloudFlare.CloudFlare(email="test@example.com", token="test", base_url=f"{base_url}/client/v4")
+    cf._base.network.session = flaredns.make_cloudflare_session()
+    zone_id = cf.zones.get(params={"name": ZONE})[0]["id"]
+    return cf, zone_id
+
+def stats(base_url):
+    return requests.get(f"{base_url}/__stats").json()
+
+def list_records(cf, zone_id):
+    snapshot = flaredns.ZoneSnapshot(cf, zone_id)
+    snapshot.refresh()
+    return snapshot
+
+@pytest.mark.parametrize("hosts, max_per_page, pages", [(150, 100, 3), (50, 100, 1), (50, 50, 2)])
+def test_snapshot_pagination(mock_cloudflare, hosts, max_per_page, pages):
+    base_url = mock_cloudflare("--zone", ZONE, "--records", str(hosts), "--max-per-page", str(max_per_page))
+    cf, zone_id = connect(base_url)
+    snapshot = list_records(cf, zone_id)
+    # Every host has an A and an AAAA record
+    assert len(snapshot.by_id) == 2 * hosts
+    assert snapshot.get(f"host{hosts - 1}.{ZONE}", "AAAA")["content"] == f"2001:db8:ffff::{hosts - 1:x}"
+    assert stats(base_url)["GET /zones/:id/dns_records"] == pages
+
+def test_batch_update(mock_cloudflare):
+    base_url = mock_cloudflare("--zone", ZONE, "--records", "3")
+    cf, zone_id = connect(base_url)
+    snapshot = list_records(cf, zone_id)
+    pending = flaredns.PendingUpdates()
+    pending.patch(zone_id, snapshot.get(f"host0.{ZONE}", "A"), {"content": "198.51.100.1"})
+    pending.patch(zone_id, snapshot.get(f"host1.{ZONE}", "A"), {"content": "198.51.100.2"})
+    # A later change of the same record replaces the earlier one
+    pending.patch(zone_id, snapshot.get(f"host1.{ZONE}", "A"), {"content": "198.51.100.3"})
+    assert len(pending) == 2
+    assert pending.submit_zone(cf, zone_id, snapshot) == 0
+    assert len(pending) == 0
+    requests_made = stats(base_url)
+    assert requests_made["POST /zones/:id/dns_records/batch"] == 1
+    assert "PATCH /zones/:id/dns_records/:id" not in requests_made
+    # The snapshot has been updated, too
+    assert snapshot.get(f"host1.{ZONE}", "A")["content"] == "198.51.100.3"
+    records = list_records(cf, zone_id)
+    assert records.get(f"host0.{ZONE}", "A")["content"] == "198.51.100.1"
+    assert records.get(f"host1.{ZONE}", "A")["content"] == "198.51.100.3"
+
+def test_batch_fallback(mock_cloudflare):
+    base_url = mock_cloudflare("--zone", ZONE, "--records", "3")
+    cf, zone_id = connect(base_url)
+    snapshot = list_records(cf, zone_id)
+    # The record has been recreated since the snapshot was taken => The whole batch is rejected
+    outdated = dict(snapshot.get(f"host0.{ZONE}", "A"), id=OUTDATED_RECORD_ID)
+    pending = flaredns.PendingUpdates()
+    pending.patch(zone_id, outdated, {"content": "198.51.100.1"})
+    pending.patch(zone_id, snapshot.get(f"host1.{ZONE}", "A"), {"content": "198.51.100.2"})
+    assert pending.submit_zone(cf, zone_id, snapshot) == 0
+    requests_made = stats(base_url)
+    assert requests_made["POST /zones/:id/dns_records/batch"] == 1
+    # Outdated ID, retry with the looked up ID, the other change
+    assert requests_made["PATCH /zones/:id/dns_records/:id"] == 3
+    assert snapshot.is_stale()
+    records = list_records(cf, zone_id)
+    assert records.get(f"host0.{ZONE}", "A")["content"] == "198.51.100.1"
+    assert records.get(f"host1.{ZONE}", "A")["content"] == "198.51.100.2"
+
+def test_batch_failure_without_fallback(mock_cloudflare):
+    base_url = mock_cloudflare("--zone", ZONE, "--records", "3")
+    cf, zone_id = connect(base_url)
+    snapshot = list_records(cf, zone_id)
+    # Unknown zone (7003) isn't a record error, so the changes aren't retried one by one
+    unknown_zone_id = "f" * 32
+    pending = flaredns.PendingUpdates()
+    pending.patch(unknown_zone_id, snapshot.get(f"host0.{ZONE}", "A"), {"content": "198.51.100.1"})
+    pending.patch(unknown_zone_id, snapshot.get(f"host1.{ZONE}", "A"), {"content": "198.51.100.2"})
+    assert pending.submit_zone(cf, unknown_zone_id) == 2
+    assert "PATCH /zones/:id/dns_records/:id" not in stats(base_url)
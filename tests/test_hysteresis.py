@@ -0,0 +1,65 @@
+import flaredns
+
+HOSTNAME = "host.example.com"
+
+def test_min_dwell(clock):
+    hysteresis = flaredns.Hysteresis(min_dwell=60)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+    assert hysteresis.pop_retry_delay() == 60
+    clock.advance(30)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+    assert hysteresis.pop_retry_delay() == 30
+    clock.advance(30)
+    assert hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+
+def test_changed_again_restarts_dwell(clock):
+    hysteresis = flaredns.Hysteresis(min_dwell=60)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+    clock.advance(50)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.3")
+    clock.advance(50)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.3")
+    clock.advance(10)
+    assert hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.3")
+
+def test_oscillation_is_dropped(clock):
+    # A => B => A within min_dwell: Nothing is published and B has to be stable again
+    hysteresis = flaredns.Hysteresis(min_dwell=60)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+    clock.advance(30)
+    hysteresis.settle(HOSTNAME, "A", "192.0.2.1")
+    assert hysteresis.pending == {}
+    clock.advance(40)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+
+def test_max_updates_counts_confirmed_changes(clock):
+    hysteresis = flaredns.Hysteresis(max_updates=1, window=3600)
+    assert hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+    # The update failed: Retried without counting
+    clock.advance(10)
+    assert hysteresis.allow(HOSTNAME, "A", "192.0.2.1", "192.0.2.2")
+    assert len(hysteresis.updates) == 0
+    # The record now has the new content
+    hysteresis.settle(HOSTNAME, "A", "192.0.2.2")
+    assert len(hysteresis.updates) == 1
+    clock.advance(100)
+    assert not hysteresis.allow(HOSTNAME, "A", "192.0.2.2", "192.0.2.3")
+    assert hysteresis.pop_retry_delay() == 3600 - 100
+    clock.advance(3600)
+    assert hysteresis.allow(HOSTNAME, "A", "192.0.2.2", "192.0.2.3")
+
+def test_state_round_trip(clock):
+    hysteresis = flaredns.Hysteresis(min_dwell=60)
+    assert not hysteresis.allow(HOSTNAME, "AAAA", "2001:db8::1", "2001:db8::2")
+    state = hysteresis.state()
+    # Restored in a new process with a different monotonic clock
+    clock.advance(-500)
+    restored = flaredns.Hysteresis(min_dwell=60)
+    restored.restore(state)
+    clock.advance(30)
+    assert not restored.allow(HOSTNAME, "AAAA", "2001:db8::1", "2001:db8::2")
+    clock.advance(31)
+    assert restored.allow(HOSTNAME, "AAAA", "2001:db8::1", "2001:db8::2")
+
+def test_empty_state():
+    assert flaredns.Hysteresis().state() is None
@@ -0,0 +1,76 @@
+import ipaddress
+import socket
+import struct
+import flaredns
+
+TRANSACTION_ID = bytes(range(12))
+
+def stun_attribute(attr_type, family, port, packed):
+    value = struct.pack("!BBH", 0, family, port) + packed
+    return struct.pack("!HH", attr_type, len(value)) + value
+
+def stun_response(*attributes, msg_type=flaredns.STUN_BINDING_SUCCESS, transaction_id=TRANSACTION_ID):
+    body = b"".join(attributes)
+    return struct.pack("!HHI12s", msg_type, len(body), flaredns.STUN_MAGIC_COOKIE, transaction_id) + body
+
+def xor(packed, key):
+    return bytes(a ^ b for a, b in zip(packed, key))
+
+def test_stun_xor_mapped_address_ipv4():
+    key = struct.pack("!I", flaredns.STUN_MAGIC_COOKIE)
+    data = stun_response(stun_attribute(flaredns.STUN_ATTR_XOR_MAPPED_ADDRESS, 0x01, 0, xor(socket.inet_aton("198.51.100.7"), key)))
+    assert flaredns.parse_stun_response(data, TRANSACTION_ID) == "198.51.100.7"
+
+def test_stun_xor_mapped_address_ipv6():
+    key = struct.pack("!I", flaredns.STUN_MAGIC_COOKIE) + TRANSACTION_ID
+    packed = ipaddress.IPv6Address("2001:db8::1234").packed
+    data = stun_response(stun_attribute(flaredns.STUN_ATTR_XOR_MAPPED_ADDRESS, 0x02, 0, xor(packed, key)))
+    assert flaredns.parse_stun_response(data, TRANSACTION_ID) == "2001:db8::1234"
+
+def test_stun_prefers_xor_mapped_address():
+    key = struct.pack("!I", flaredns.STUN_MAGIC_COOKIE)
+    data = stun_response(
+        stun_attribute(flaredns.STUN_ATTR_MAPPED_ADDRESS, 0x01, 0, socket.inet_aton("10.0.0.1")),
+        stun_attribute(flaredns.STUN_ATTR_XOR_MAPPED_ADDRESS, 0x01, 0, xor(socket.inet_aton("198.51.100.7"), key)),
+    )
+    assert flaredns.parse_stun_response(data, TRANSACTION_ID) == "198.51.100.7"
+
+def test_stun_mapped_address_only():
+    data = stun_response(stun_attribute(flaredns.STUN_ATTR_MAPPED_ADDRESS, 0x01, 0, socket.inet_aton("198.51.100.8")))
+    assert flaredns.parse_stun_response(data, TRANSACTION_ID) == "198.51.100.8"
+
+def test_stun_invalid_responses():
+    attribute = stun_attribute(flaredns.STUN_ATTR_MAPPED_ADDRESS, 0x01, 0, socket.inet_aton("198.51.100.8"))
+    assert flaredns.parse_stun_response(b"\x01\x01", TRANSACTION_ID) is None
+    assert flaredns.parse_stun_response(stun_response(attribute, transaction_id=bytes(12)), TRANSACTION_ID) is None
+    assert flaredns.parse_stun_response(stun_response(attribute, msg_type=0x0111), TRANSACTION_ID) is None
+    # Truncated attribute
+    assert flaredns.parse_stun_response(stun_response(attribute)[:-2], TRANSACTION_ID) is None
+
+def rtattr(attr_type, value):
+    data = struct.pack("=HH", 4 + len(value), attr_type) + value
+    # Attributes are padded to a multiple of 4 bytes
+    return data + b"\0" * (-len(data) % 4)
+
+# Unlikely to exist, so the index is used as the interface name
+INTERFACE_INDEX = 4000000
+
+def test_ifaddrmsg_ipv6_with_flags():
+    payload = struct.pack("=BBBBI", socket.AF_INET6, 64, flaredns.IFA_F_TEMPORARY, 0, INTERFACE_INDEX)
+    payload += rtattr(flaredns.IFA_ADDRESS, ipaddress.IPv6Address("2001:db8::5").packed)
+    payload += rtattr(flaredns.IFA_FLAGS, struct.pack("=I", 0x200 | flaredns.IFA_F_DEPRECATED))
+    address = flaredns.parse_ifaddrmsg(payload)
+    assert address == flaredns.InterfaceAddress(str(INTERFACE_INDEX), ipaddress.IPv6Address("2001:db8::5"), 64, 0, 0x200 | flaredns.IFA_F_DEPRECATED)
+
+def test_ifaddrmsg_prefers_local_address():
+    # Point-to-point link: IFA_ADDRESS is the peer
+    payload = struct.pack("=BBBBI", socket.AF_INET, 32, 0, 0, INTERFACE_INDEX)
+    payload += rtattr(flaredns.IFA_ADDRESS, socket.inet_aton("203.0.113.1"))
+    payload += rtattr(flaredns.IFA_LOCAL, socket.inet_aton("198.51.100.9"))
+    address = flaredns.parse_ifaddrmsg(payload)
+    assert address.address == ipaddress.IPv4Address("198.51.100.9")
+    assert address.prefixlen == 32
+
+def test_ifaddrmsg_without_address():
+    payload = struct.pack("=BBBBI", socket.AF_INET, 24, 0, 0, INTERFACE_INDEX) + rtattr(flaredns.IFA_FLAGS, struct.pack("=I", 0))
+    assert flaredns.parse_ifaddrmsg(payload) is None
@@ -0,0 +1,45 @@
+import ipaddress
+import pytest
+import flaredns
+
+RECORDS = [
+    {"id": "1", "type": "AAAA", "name": "a.example.com", "content": "2001:db8:1:2::10"},
+    {"id": "2", "type": "AAAA", "name": "b.example.com", "content": "2001:db8:1:2:aaaa:bbbb:cccc:dddd"},
+    # Outside of the old prefix
+    {"id": "3", "type": "AAAA", "name": "c.example.com", "content": "2001:db8:9:9::10"},
+    {"id": "4", "type": "A", "name": "a.example.com", "content": "192.0.2.1"},
+    {"id": "5", "type": "AAAA", "name": "d.example.com", "content": "not an address"},
+]
+
+@pytest.fixture(params=["numpy", "python"])
+def numpy_mode(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(flaredns, "np", None)
+    return request.param
+
+def test_renumber_keeps_host_bits(numpy_mode):
+    plan = flaredns.plan_ipv6_renumbering(RECORDS, ipaddress.IPv6Network("2001:db8:1:2::/64"), ipaddress.IPv6Network("2001:db8:5:6::/64"))
+    assert [(record["id"], content) for record, content in plan] == [
+        ("1", "2001:db8:5:6::10"),
+        ("2", "2001:db8:5:6:aaaa:bbbb:cccc:dddd"),
+    ]
+
+def test_renumber_same_prefix_is_empty(numpy_mode):
+    prefix = ipaddress.IPv6Network("2001:db8:1:2::/64")
+    assert flaredns.plan_ipv6_renumbering(RECORDS, prefix, prefix) == []
+
+def test_renumber_short_prefix(numpy_mode):
+    # Prefix boundary within the high 64 bit word
+    plan = flaredns.plan_ipv6_renumbering(RECORDS, ipaddress.IPv6Network("2001:db8::/32"), ipaddress.IPv6Network("2001:db9::/32"))
+    assert sorted(content for _, content in plan) == ["2001:db9:1:2::10", "2001:db9:1:2:aaaa:bbbb:cccc:dddd", "2001:db9:9:9::10"]
+
+def test_renumber_long_prefix(numpy_mode):
+    # Prefix boundary within the low 64 bit word
+    plan = flaredns.plan_ipv6_renumbering(RECORDS, ipaddress.IPv6Network("2001:db8:1:2::/80"), ipaddress.IPv6Network("2001:db8:1:2:ffff::/80"))
+    assert [content for _, content in plan] == ["2001:db8:1:2:ffff::10"]
+
+def test_renumber_prefix_length_mismatch(numpy_mode):
+    with pytest.raises(ValueError):
+        flaredns.plan_ipv6_renumbering(RECORDS, ipaddress.IPv6Network("2001:db8:1:2::/64"), ipaddress.IPv6Network("2001:db8:5::/48"))
@@ -0,0 +1,55 @@
+import flaredns
+
+def make_host(interval=60):
+    return flaredns.Host("host.example.com", ipv4=True, interval=interval)
+
+def test_reschedule_keeps_deadlines(clock):
+    host = make_host()
+    scheduler = flaredns.Scheduler([host])
+    assert scheduler.pop_due() == [host]
+    # The update took 5 seconds
+    clock.advance(5)
+    scheduler.reschedule(host)
+    assert host.next_update == clock.now - 5 + 60
+    assert scheduler.pop_due() == []
+    clock.advance(55)
+    assert scheduler.pop_due() == [host]
+
+def test_reschedule_skips_missed_deadlines(clock):
+    host = make_host()
+    scheduler = flaredns.Scheduler([host])
+    start = clock.now
+    assert scheduler.pop_due() == [host]
+    # E.g. suspended for 250 seconds: The next deadline is the next one on the original grid
+    clock.advance(250)
+    scheduler.reschedule(host)
+    assert host.next_update == start + 300
+    assert scheduler.time_until_next() == 50
+
+def test_reschedule_deadline_reached_exactly(clock):
+    host = make_host()
+    scheduler = flaredns.Scheduler([host])
+    start = clock.now
+    scheduler.pop_due()
+    clock.advance(120)
+    scheduler.reschedule(host)
+    assert host.next_update == start + 180
+
+def test_reschedule_retry(clock):
+    host = make_host()
+    scheduler = flaredns.Scheduler([host])
+    scheduler.pop_due()
+    scheduler.reschedule(host, retry_delay=5)
+    assert scheduler.time_until_next() == 5
+    scheduler.pop_due(clock.now + 5)
+    # Retries happen at least every interval
+    scheduler.reschedule(host, retry_delay=600)
+    assert scheduler.time_until_next() == 60
+
+def test_reschedule_drops_one_shot_hosts(clock):
+    host = make_host(interval=0)
+    scheduler = flaredns.Scheduler([host])
+    assert scheduler.pop_due() == [host]
+    scheduler.reschedule(host)
+    assert len(scheduler) == 0
+    assert scheduler.time_until_next() is None
@@ -0,0 +1,47 @@
+import flaredns
+from flaredns import PRIORITY_HIGH, PRIORITY_LOW
+
+def test_reserve_for_high_priority(clock):
+    bucket = flaredns.TokenBucket(rate=1, capacity=5, reserve=1)
+    for _ in range(4):
+        assert bucket._take(PRIORITY_LOW) == 0
+    # The last token is left to high priority requests
+    assert bucket._take(PRIORITY_LOW) == 1
+    assert bucket._take(PRIORITY_HIGH) == 0
+    assert bucket._take(PRIORITY_HIGH) == 1
+    clock.advance(1)
+    assert bucket._take(PRIORITY_HIGH) == 0
+
+def test_low_priority_waits_for_high_priority(clock):
+    bucket = flaredns.TokenBucket(rate=2, capacity=5, reserve=1)
+    bucket.high_priority_waiting = 1
+    assert bucket._take(PRIORITY_LOW) == 0.5
+    assert bucket._take(PRIORITY_HIGH) == 0
+
+def test_refill_is_capped(clock):
+    bucket = flaredns.TokenBucket(rate=1, capacity=3)
+    for _ in range(3):
+        assert bucket._take(PRIORITY_HIGH) == 0
+    clock.advance(100)
+    for _ in range(3):
+        assert bucket._take(PRIORITY_HIGH) == 0
+    assert bucket._take(PRIORITY_HIGH) == 1
+
+def test_pause(clock):
+    bucket = flaredns.TokenBucket(rate=1, capacity=5)
+    bucket.pause(10)
+    assert bucket._take(PRIORITY_HIGH) == 10
+    assert bucket._take(PRIORITY_LOW) == 10
+    clock.advance(4)
+    # A shorter pause doesn't shorten the current one
+    bucket.pause(1)
+    assert bucket._take(PRIORITY_HIGH) == 6
+    clock.advance(6)
+    assert bucket._take(PRIORITY_HIGH) == 0
+
+def test_make_rate_limit_bucket():
+    bucket = flaredns.make_rate_limit_bucket(1200, 300, 100)
+    assert bucket.capacity == 100
+    assert bucket.reserve == 20
+    # Burst + refill within one window don't exceed the limit
+    assert bucket.capacity + bucket.rate * 300 == 1200